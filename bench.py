@@ -0,0 +1,419 @@
+# bench.py — офлайн-бенчмарк команд Флер на имитации Discord
+#
+#   python bench.py                                  # прогон со значениями по умолчанию
+#   python bench.py --messages 1000000 --save new.json
+#   python bench.py --compare base.json --threshold 0.25   # код 1 при регрессии
+#
+# Сеть не нужна: каналы, история, удаление и права имитируются в процессе,
+# с настраиваемой задержкой ответа и лимитами запросов.
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+
+import main
+
+BENCH_GUILD_ID = 1  # сервер с настройками по умолчанию
+
+# ---------- имитация Discord ----------
+class FakeAPI:
+    """Общие для всех каналов задержка, лимиты и счётчик запросов."""
+
+    def __init__(self, latency: float, rate_limit: float):
+        self.latency = latency
+        self.rate_limit = rate_limit      # запросов в секунду на маршрут, 0 — без лимита
+        self.calls: Counter[str] = Counter()
+        self.rate_limited = 0
+        self._next_free: dict[str, float] = {}
+
+    async def request(self, route: str) -> None:
+        self.calls[route] += 1
+        if self.rate_limit:
+            # как discord.py: упёрлись в лимит — ждём и повторяем
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            free = self._next_free.get(route, now)
+            if free > now:
+                self.rate_limited += 1
+                await asyncio.sleep(free - now)
+            self._next_free[route] = max(free, now) + 1 / self.rate_limit
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.rate_limited = 0
+        self._next_free.clear()
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.display_name = f"player{user_id}"
+        self.mention = f"<@{user_id}>"
+
+class FakeMessage:
+    __slots__ = ("id", "author", "content", "jump_url", "_channel")
+
+    def __init__(self, channel: "FakeChannel", msg_id: int, author: FakeUser, content: str):
+        self.id = msg_id
+        self.author = author
+        self.content = content
+        self.jump_url = f"https://discord.com/channels/1/{channel.id}/{msg_id}"
+        self._channel = channel
+
+    async def delete(self):
+        await self._channel.api.request("delete")
+        self._channel._delete_ids([self.id])
+
+class FakePartialMessage:
+    def __init__(self, channel: "FakeChannel", msg_id: int):
+        self.channel = channel
+        self.id = msg_id
+
+    async def delete(self):
+        await self.channel.api.request("delete")
+        if self.id in self.channel.deleted or not self.channel._has(self.id):
+            raise discord.NotFound(_FakeResponse(404), "Unknown Message")
+        self.channel._delete_ids([self.id])
+
+    async def edit(self, **fields):
+        await self.channel.api.request("edit")
+
+class _FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "fake"
+
+class FakeChannel(discord.TextChannel):
+    """Текстовый канал: история в компактных массивах, удаление помечает id."""
+
+    def __init__(self, api: FakeAPI, channel_id: int, name: str, category_id: int | None = None):
+        self.api = api
+        self.id = channel_id
+        self.name = name
+        self.category_id = category_id
+        self.position = 0
+        self.guild = None
+        self.ids = array("Q")
+        self.authors = array("Q")
+        self.texts = array("H")
+        self.pool: list[str] = []
+        self.deleted: set[int] = set()
+        self.member_overwrites: dict[int, discord.PermissionOverwrite] = {}
+
+    def __repr__(self):
+        return f"<FakeChannel {self.name}>"
+
+    def seed(self, count: int, days: float, phrase: str, match_ratio: float, authors: int,
+             rng: random.Random) -> None:
+        """Заполняет канал синтетическими сообщениями за последние `days` дней."""
+        self.pool = [f"обычное сообщение номер {i}" for i in range(200)]
+        self.pool.append(f"вот {phrase} и ещё текст")
+        match_text = len(self.pool) - 1
+        now = discord.utils.utcnow()
+        start = discord.utils.time_snowflake(now - timedelta(days=days))
+        end = discord.utils.time_snowflake(now - timedelta(seconds=5))
+        step = max(1, (end - start) // max(count, 1))
+        for i in range(count):
+            self.ids.append(start + i * step)
+            self.authors.append(rng.randrange(1, authors + 1))
+            self.texts.append(match_text if rng.random() < match_ratio else rng.randrange(200))
+
+    def _has(self, msg_id: int) -> bool:
+        i = bisect_left(self.ids, msg_id)
+        return i < len(self.ids) and self.ids[i] == msg_id
+
+    def _delete_ids(self, ids) -> None:
+        self.deleted.update(ids)
+
+    def _message(self, i: int) -> FakeMessage:
+        return FakeMessage(self, self.ids[i], FakeUser(self.authors[i]), self.pool[self.texts[i]])
+
+    async def history(self, *, limit=100, before=None, after=None, oldest_first=None, around=None):
+        await self.api.request("history")
+        hi = bisect_left(self.ids, before.id) if before else len(self.ids)
+        lo = bisect_right(self.ids, after.id) if after else 0
+        returned = 0
+        i = hi - 1
+        while i >= lo and (limit is None or returned < limit):
+            if self.ids[i] not in self.deleted:
+                yield self._message(i)
+                returned += 1
+            i -= 1
+
+    async def delete_messages(self, messages, *, reason=None):
+        await self.api.request("bulk_delete")
+        self._delete_ids(m.id for m in messages)
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(self, message_id)
+
+    async def send(self, content=None, **kwargs):
+        await self.api.request("send")
+        return FakeMessage(self, discord.utils.time_snowflake(discord.utils.utcnow()),
+                           FakeUser(0), content or "")
+
+    def overwrites_for(self, obj) -> discord.PermissionOverwrite:
+        return self.member_overwrites.get(obj.id, discord.PermissionOverwrite())
+
+    async def set_permissions(self, target, *, overwrite=discord.utils.MISSING, reason=None, **perms):
+        await self.api.request("permissions")
+        if overwrite is None:
+            self.member_overwrites.pop(target.id, None)
+        elif overwrite is not discord.utils.MISSING:
+            self.member_overwrites[target.id] = overwrite
+        else:
+            self.member_overwrites[target.id] = discord.PermissionOverwrite(**perms)
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+class FakeResponse:
+    def __init__(self, api: FakeAPI):
+        self.api = api
+
+    async def send_message(self, *args, **kwargs):
+        await self.api.request("interaction")
+
+    async def defer(self, **kwargs):
+        await self.api.request("interaction")
+
+class FakeFollowup:
+    def __init__(self, api: FakeAPI, channel: FakeChannel):
+        self.api = api
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        await self.api.request("interaction")
+        return FakeMessage(self.channel, 1, FakeUser(0), content or "")
+
+class FakeInteraction:
+    def __init__(self, api: FakeAPI, user: FakeUser, channel: FakeChannel):
+        self.user = user
+        self.channel = channel
+        self.guild = None
+        self.guild_id = BENCH_GUILD_ID
+        self.namespace = SimpleNamespace()
+        self.response = FakeResponse(api)
+        self.followup = FakeFollowup(api, channel)
+        self._api = api
+
+    async def delete_original_response(self):
+        await self._api.request("interaction")
+
+# ---------- сценарии ----------
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(latencies: list[float], work: int, elapsed: float, api: FakeAPI) -> dict:
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "throughput": round(work / elapsed, 1) if elapsed else 0.0,
+        "rest_calls": dict(api.calls),
+        "rest_total": sum(api.calls.values()),
+        "rate_limited": api.rate_limited,
+    }
+
+async def bench_purge(args, api: FakeAPI, kind: str) -> dict:
+    """очиститьфразы / очиститьдо на засеянном канале; пропускная способность — просмотр в секунду."""
+    latencies, scanned = [], 0
+    api_calls: Counter[str] = Counter()
+    for run in range(args.repeat):
+        channel = FakeChannel(api, 10_000 + run, "flood")
+        channel.seed(args.messages, args.days, args.phrase, args.match_ratio, 50,
+                     random.Random(args.seed + run))
+        if kind == "phrases":
+            job = main.PurgeJob("contains", args.count, "bench", args.phrase)
+        else:
+            # очиститьдо: от сообщения посередине истории и N перед ним
+            target = channel.ids[len(channel.ids) // 2]
+            job = main.PurgeJob("all", args.count, "bench", before=target + 1)
+        index = None
+        if args.index:
+            # индекс дочитывается до замера, как при старте бота
+            main.INDEX_BACKFILL_LIMIT = max(main.INDEX_BACKFILL_LIMIT, args.messages + 1)
+            index = main.MessageIndex()
+            await index.backfill(channel)
+        api.reset()
+        t = time.perf_counter()
+        await main.stream_purge(channel, job, index=index)
+        latencies.append(time.perf_counter() - t)
+        scanned += job.scanned
+        api_calls.update(api.calls)
+    api.calls = api_calls
+    # засев канала в замер не входит
+    result = summarize(latencies, scanned, sum(latencies), api)
+    result["throughput_unit"] = "сообщений/с"
+    return result
+
+def build_map(args, api: FakeAPI, rng: random.Random) -> list[FakeChannel]:
+    graph = main.guilds.get(BENCH_GUILD_ID).rooms = main.RoomGraph("bench_rooms.json")
+    main.channel_index = main.ChannelIndex()
+    rooms = [FakeChannel(api, 100_000 + i, f"комната-{i}", main.ALLOWED_CATEGORY_ID)
+             for i in range(args.rooms)]
+    for i, room in enumerate(rooms):
+        exits = rng.sample(range(args.rooms), min(args.exits, args.rooms))
+        text = f"{room.name}: " + ", ".join(rooms[j].name for j in exits if j != i)
+        graph.set_message(500_000 + i, text)
+        main.channel_index.add(room)
+    graph.loaded = True
+    return rooms
+
+async def bench_autocomplete(args, api: FakeAPI) -> dict:
+    rng = random.Random(args.seed)
+    rooms = build_map(args, api, rng)
+    # /move с маршрутом: подсказки не ограничены соседними комнатами; параметр ищем под именем из Discord
+    routed = FakeInteraction(api, FakeUser(1), rooms[0])
+    setattr(routed.namespace, main.move.get_parameter("route").display_name, True)
+    suggested = {choice.value for choice in await main.room_autocomplete(routed, "комната")}
+    if not suggested - set(main.guilds.get(BENCH_GUILD_ID).rooms.exits(rooms[0].name)):
+        raise SystemExit("автокомплит /move не видит параметр маршрута")
+    api.reset()
+    latencies = []
+    queries = ["", "ком", "комн", "rjv", "кмната", "-1", "мната-4"]
+    started = time.perf_counter()
+    for _ in range(args.queries):
+        room = rng.choice(rooms)
+        interaction = FakeInteraction(api, FakeUser(1), room)
+        t = time.perf_counter()
+        await main.room_autocomplete(interaction, rng.choice(queries))
+        latencies.append(time.perf_counter() - t)
+    result = summarize(latencies, args.queries, time.perf_counter() - started, api)
+    result["throughput_unit"] = "запросов/с"
+    return result
+
+async def bench_move(args, api: FakeAPI) -> dict:
+    rng = random.Random(args.seed)
+    rooms = build_map(args, api, rng)
+    by_name = {room.name: room for room in rooms}
+    api.reset()
+    latencies = []
+    started = time.perf_counter()
+    player = FakeUser(42)
+    here = rooms[0]
+    for _ in range(args.moves):
+        exits = main.guilds.get(BENCH_GUILD_ID).rooms.exits(here.name)
+        if not exits:
+            here = rng.choice(rooms)
+            continue
+        target = rng.choice(exits)
+        t = time.perf_counter()
+        await main.move.callback(FakeInteraction(api, player, here), target)
+        latencies.append(time.perf_counter() - t)
+        here = by_name[target]
+    # логи копятся в очереди без воркера — в замер не входят
+    for state in main.guilds:
+        while not state.log.queue.empty():
+            state.log.queue.get_nowait()
+    result = summarize(latencies, len(latencies), time.perf_counter() - started, api)
+    result["throughput_unit"] = "перемещений/с"
+    return result
+
+SCENARIOS = {
+    "purge_phrases": lambda args, api: bench_purge(args, api, "phrases"),
+    "purge_before": lambda args, api: bench_purge(args, api, "before"),
+    "autocomplete": bench_autocomplete,
+    "move": bench_move,
+}
+
+# ---------- сравнение ----------
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Регрессии относительно сохранённого прогона: задержки, пропускная способность, число запросов."""
+    problems = []
+    for name, res in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            # совсем короткие замеры шумят — сравниваем только от 1 мс
+            if base[key] >= 1 and res[key] > base[key] * (1 + threshold):
+                problems.append(f"{name}: {key} {base[key]} → {res[key]}")
+        if base["throughput"] and res["throughput"] < base["throughput"] * (1 - threshold):
+            problems.append(f"{name}: throughput {base['throughput']} → {res['throughput']}")
+        if res["rest_total"] > base["rest_total"] * (1 + threshold):
+            problems.append(f"{name}: REST-запросов {base['rest_total']} → {res['rest_total']}")
+    return problems
+
+def revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def unthrottle() -> None:
+    """Снимает лимиты планировщика: меряем сам код, а не бюджеты Discord."""
+    main.ROUTE_BUDGETS = {route: (10**9, 1.0) for route in main.ROUTE_BUDGETS}
+    main.GLOBAL_BUDGET = (10**9, 1.0)
+    main.rest = main.RestScheduler()
+
+async def run(args) -> dict:
+    api = FakeAPI(args.latency_ms / 1000, args.rate_limit)
+    if not args.real_budgets:
+        unthrottle()
+    names = args.only.split(",") if args.only else list(SCENARIOS)
+    results = {}
+    for name in names:
+        results[name] = await SCENARIOS[name](args, api)
+        res = results[name]
+        print(f"{name:15} p50 {res['p50_ms']:>9.3f} мс  p99 {res['p99_ms']:>9.3f} мс  "
+              f"{res['throughput']:>12} {res['throughput_unit']:14} "
+              f"REST {res['rest_total']:>7}  429 {res['rate_limited']}")
+    return {"revision": revision(), "config": vars(args), "results": results}
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк команд Флер")
+    parser.add_argument("--messages", type=int, default=10_000, help="сообщений в канале")
+    parser.add_argument("--days", type=float, default=30, help="за сколько дней история")
+    parser.add_argument("--match-ratio", type=float, default=0.05, help="доля сообщений с фразой")
+    parser.add_argument("--phrase", default="купи скидку")
+    parser.add_argument("--count", type=int, default=500, help="N для очисток")
+    parser.add_argument("--rooms", type=int, default=2_000)
+    parser.add_argument("--exits", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=2_000, help="запросов автокомплита")
+    parser.add_argument("--moves", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3, help="прогонов каждой очистки")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа имитации")
+    parser.add_argument("--rate-limit", type=float, default=0, help="запросов/с на маршрут, 0 — без лимита")
+    parser.add_argument("--real-budgets", action="store_true", help="оставить бюджеты планировщика")
+    parser.add_argument("--index", action="store_true", help="очистки через локальный индекс сообщений")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", help="сценарии через запятую: " + ",".join(SCENARIOS))
+    parser.add_argument("--save", help="записать результаты в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для проверки регрессий")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.threshold)
+        if problems:
+            print(f"Регрессии относительно {baseline.get('revision')}:")
+            for line in problems:
+                print("  " + line)
+            return 1
+        print(f"Регрессий относительно {baseline.get('revision')} нет.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,31 +1,424 @@
 # bot.py
+import asyncio
+import contextvars
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+import unicodedata
 import discord
 from discord.ext import commands
-from datetime import datetime, timezone
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
 import re
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
 from difflib import get_close_matches
-from typing import List
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Awaitable, Callable, Iterable, List
 from discord import app_commands
 from discord.utils import get
+from aiohttp import web
 import re
 from typing import Optional
 
 
 # ══════════ НАСТРОЙКИ ══════════
 BOT_PREFIX = "!!!!"
+# значения по умолчанию — для серверов, которых нет в guilds.json
 ALLOWED_ROLE_IDS = [1407717900491554949]  # ID ролей, которым разрешены команды
 LOG_CHANNEL_ID = 1407718346081964053  # ID канала, куда писать логи
 ROOMS_SOURCE_CHANNEL_ID = 1407726599889092779  # канал, где каждое сообщение = название
 ALLOWED_CATEGORY_ID     = 1407729261321916459
+INDEXED_CHANNEL_IDS: list[int] = []  # каналы с локальным индексом сообщений — очистки без чтения истории
+GUILDS_CONFIG_PATH = "guilds.json"           # настройки серверов: {"<id сервера>": {...}}
+ROOMS_SNAPSHOT_PATH = "rooms_snapshot.json"  # снимок карты комнат для быстрого старта (свой на сервер)
+PURGE_JOBS_PATH = "purge_jobs.json"          # незавершённые очистки (продолжаются после перезапуска)
+LOCATIONS_PATH = "player_locations.json"     # в какой комнате каждый игрок (свой на сервер)
+COMMAND_TREE_HASH_PATH = "command_tree.json"  # хэш последних опубликованных slash-команд
+AUDIT_DB_PATH = "audit.sqlite3"              # журнал всех действий бота для !аудит
+SYNC_GUILD_IDS: list[int] = []  # публиковать slash-команды только на эти серверы; пусто — глобально
+METRICS_HOST = "127.0.0.1"  # адрес /metrics для Prometheus (только локально)
+METRICS_PORT = int(os.environ.get("FLER_METRICS_PORT", 9108))
+# шардинг: без переменных окружения Discord сам подскажет число шардов, и все они живут в одном процессе;
+# для нескольких процессов — FLER_SHARD_COUNT=8 и FLER_SHARD_IDS=0,1,2,3 / 4,5,6,7
+SHARD_COUNT = int(os.environ["FLER_SHARD_COUNT"]) if os.environ.get("FLER_SHARD_COUNT") else None
+SHARD_IDS = [int(i) for i in os.environ["FLER_SHARD_IDS"].split(",")] \
+    if os.environ.get("FLER_SHARD_IDS") else None
 # ════════════════════════════════
 
+@dataclass
+class GuildConfig:
+    """Настройки одного сервера; чего нет в guilds.json — берётся из констант выше."""
+    allowed_role_ids: list[int] = field(default_factory=lambda: list(ALLOWED_ROLE_IDS))
+    log_channel_id: int = LOG_CHANNEL_ID
+    rooms_source_channel_id: int = ROOMS_SOURCE_CHANNEL_ID
+    allowed_category_id: int = ALLOWED_CATEGORY_ID
+    indexed_channel_ids: list[int] = field(default_factory=lambda: list(INDEXED_CHANNEL_IDS))
+
+def load_guild_configs(path: str) -> dict[int, GuildConfig]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {int(guild_id): GuildConfig(**raw) for guild_id, raw in data.items()}
+
+GUILD_CONFIGS = load_guild_configs(GUILDS_CONFIG_PATH)
+DEFAULT_CONFIG = GuildConfig()
+
+def guild_config(guild_id: int | None) -> GuildConfig:
+    return GUILD_CONFIGS.get(guild_id, DEFAULT_CONFIG)
+
+def guild_path(path: str, guild_id: int) -> str:
+    """Файл состояния отдельного сервера: rooms_snapshot.json → rooms_snapshot.<id>.json."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{guild_id}{ext}"
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, help_command=None)
+bot = commands.AutoShardedBot(command_prefix=BOT_PREFIX, intents=intents, help_command=None,
+                              shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
 
 # --------------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---------------------
 def has_allowed_role(user: discord.Member) -> bool:
-    return any(role.id in ALLOWED_ROLE_IDS for role in user.roles)
+    allowed = guild_config(user.guild.id).allowed_role_ids
+    return any(role.id in allowed for role in user.roles)
+
+# ---------- метрики ----------
+# границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATE_WINDOW = 60  # секунд для «удалений в секунду» в сводке
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+def _labels(labels: tuple[tuple[str, object], ...]) -> str:
+    """Метки в формате Prometheus: {k="v",...}."""
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+class Metrics:
+    """Счётчики, гистограммы и датчики бота; отдаются в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: dict[str, dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: dict[str, dict[tuple, Histogram]] = defaultdict(dict)
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._rates: dict[str, deque[tuple[int, int]]] = defaultdict(deque)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[name][tuple(sorted(labels.items()))] += value
+        self._mark_rate(name, value)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        hist = self.histograms[name].get(key)
+        if hist is None:
+            hist = self.histograms[name][key] = Histogram()
+        hist.observe(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float]) -> None:
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _mark_rate(self, name: str, value: float) -> None:
+        now = int(time.monotonic())
+        window = self._rates[name]
+        if window and window[-1][0] == now:
+            window[-1] = (now, window[-1][1] + value)
+        else:
+            window.append((now, value))
+        while window and window[0][0] <= now - RATE_WINDOW:
+            window.popleft()
+
+    def rate(self, name: str) -> float:
+        """Среднее в секунду за последние RATE_WINDOW секунд."""
+        now = int(time.monotonic())
+        return sum(n for t, n in self._rates.get(name, ()) if t > now - RATE_WINDOW) / RATE_WINDOW
+
+    def total(self, name: str) -> float:
+        return sum(self.counters.get(name, {}).values())
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{name}{_labels(key)} {value:g}" for key, value in series.items()]
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, hist.buckets):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(key + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {hist.count}")
+                lines.append(f"{name}_sum{_labels(key)} {hist.sum:.6f}")
+                lines.append(f"{name}_count{_labels(key)} {hist.count}")
+        for name, fn in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {fn():g}")
+        lines.append("# TYPE fler_uptime_seconds gauge")
+        lines.append(f"fler_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class _RateLimitCounter(logging.Handler):
+    """discord.py сам повторяет запросы после 429 и только пишет об этом в лог — считаем такие записи."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if "rate limited" in record.getMessage():
+            metrics.inc("fler_rest_429_total")
+
+logging.getLogger("discord.http").addHandler(_RateLimitCounter(logging.WARNING))
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> None:
+    """Локальный HTTP-эндпоинт /metrics."""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # порт занят — бот работает и без эндпоинта, сводка есть в !метрики
+        logging.getLogger(__name__).warning("Эндпоинт метрик не запущен: %s", e)
+
+# ---------- планировщик REST-запросов ----------
+# классы приоритета: чем меньше номер, тем раньше запрос получает лимит
+PRIO_INTERACTION = 0   # ответы на команды и взаимодействия
+PRIO_PERMISSIONS = 1   # права каналов и всё, что нужно /move
+PRIO_BULK = 2          # удаления и чтение истории
+PRIO_LOG = 3           # логи и ЛС
+
+# маршрут → (запросов, за сколько секунд); считается отдельно для каждого канала
+ROUTE_BUDGETS = {
+    "interaction": (50, 1.0),
+    "permissions": (10, 10.0),
+    "send": (5, 5.0),
+    "delete": (5, 1.0),
+    "bulk_delete": (1, 1.0),
+    "history": (5, 1.0),
+    "dm": (5, 5.0),
+    "other": (5, 1.0),
+}
+GLOBAL_BUDGET = (45, 1.0)   # общий лимит бота — 50 запросов в секунду
+CHANNEL_CONCURRENCY = 2     # одновременных фоновых запросов в один канал
+
+_waiter_seq = itertools.count()
+
+class TokenBucket:
+    """Корзина токенов; при нехватке первым проходит запрос с меньшим номером приоритета."""
+
+    def __init__(self, capacity: int, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int) -> None:
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_waiter_seq), fut))
+        self._schedule()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.tokens += 1  # токен выдан, но ждущий уже отменён
+            raise
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            *_, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self.tokens -= 1
+            fut.set_result(None)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._waiters and self._timer is None:
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+class PrioritySlots:
+    """Семафор, который освободившееся место отдаёт самому приоритетному ждущему."""
+
+    def __init__(self, limit: int):
+        self.free = limit
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int) -> None:
+        if self.free and not self._waiters:
+            self.free -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_waiter_seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            *_, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.free += 1
+
+class RestScheduler:
+    """Все исходящие запросы к Discord: лимиты по маршрутам, приоритеты и потолок на канал."""
+
+    def __init__(self):
+        self._global = TokenBucket(*GLOBAL_BUDGET)
+        self._buckets: dict[tuple[str, int | None], TokenBucket] = {}
+        self._slots: dict[int, PrioritySlots] = {}
+
+    def _bucket(self, route: str, channel_id: int | None) -> TokenBucket:
+        bucket = self._buckets.get((route, channel_id))
+        if bucket is None:
+            budget = ROUTE_BUDGETS.get(route, ROUTE_BUDGETS["other"])
+            bucket = self._buckets[(route, channel_id)] = TokenBucket(*budget)
+        return bucket
+
+    @property
+    def waiting(self) -> int:
+        return (self._global.waiting
+                + sum(b.waiting for b in self._buckets.values())
+                + sum(s.waiting for s in self._slots.values()))
+
+    async def call(self, priority: int, route: str, channel_id: int | None,
+                   func: Callable[..., Awaitable], *args, **kwargs):
+        """Выполняет func(*args, **kwargs), когда для маршрута есть лимит."""
+        slots = None
+        queued = time.perf_counter()
+        # потолок на канал — только для фоновой работы, интерактив его не ждёт
+        if priority >= PRIO_BULK and channel_id is not None:
+            slots = self._slots.get(channel_id)
+            if slots is None:
+                slots = self._slots[channel_id] = PrioritySlots(CHANNEL_CONCURRENCY)
+            await slots.acquire(priority)
+        try:
+            await self._bucket(route, channel_id).acquire(priority)
+            await self._global.acquire(priority)
+            started = time.perf_counter()
+            metrics.observe("fler_rest_wait_seconds", started - queued, priority=priority)
+            try:
+                return await func(*args, **kwargs)
+            except discord.HTTPException as e:
+                metrics.inc("fler_rest_errors_total", route=route, status=e.status)
+                if e.status == 429:
+                    metrics.inc("fler_rest_429_total")
+                raise
+            finally:
+                metrics.observe("fler_rest_seconds", time.perf_counter() - started, route=route)
+        finally:
+            if slots is not None:
+                slots.release()
+
+rest = RestScheduler()
+metrics.gauge("fler_rest_waiting", lambda: rest.waiting)
+
+HISTORY_PAGE = 100  # максимум сообщений за один запрос истории
+
+async def _fetch_page(channel: discord.abc.Messageable,
+                      before: discord.abc.Snowflake | None,
+                      after: discord.abc.Snowflake | None) -> list[discord.Message]:
+    return [msg async for msg in channel.history(limit=HISTORY_PAGE, before=before,
+                                                 after=after, oldest_first=False)]
+
+async def history_pages(channel: discord.abc.Messageable,
+                        before: discord.abc.Snowflake | None = None,
+                        after: discord.abc.Snowflake | None = None,
+                        priority: int = PRIO_BULK):
+    """Страницы истории от новых к старым; каждая — отдельный запрос через планировщик."""
+    cursor = before
+    while True:
+        page = await rest.call(priority, "history", channel.id, _fetch_page, channel, cursor, after)
+        metrics.inc("fler_history_pages_total")
+        metrics.inc("fler_messages_scanned_total", len(page))
+        if page:
+            yield page
+        if len(page) < HISTORY_PAGE:
+            return
+        cursor = discord.Object(id=page[-1].id)
+
+async def iter_history(channel: discord.abc.Messageable,
+                       before: discord.abc.Snowflake | None = None,
+                       after: discord.abc.Snowflake | None = None,
+                       priority: int = PRIO_BULK):
+    """История от новых к старым по одному сообщению."""
+    async for page in history_pages(channel, before, after, priority):
+        for msg in page:
+            yield msg
 
 # ------------------------------------------------------------------
 # УНИВЕРСАЛЬНОЕ ЛОГИРОВАНИЕ
@@ -40,30 +433,912 @@ def parse_location_line(text: str) -> tuple[str, list[str]] | None:
     exits = [e.strip() for e in exits_str.split(',') if e.strip()]
     return room.strip(), exits
 
+# ---------- поиск по названиям ----------
+# раскладка: одни и те же клавиши в QWERTY и ЙЦУКЕН
+_LAT_KEYS = "`qwertyuiop[]asdfghjkl;'zxcvbnm,."
+_CYR_KEYS = "ёйцукенгшщзхъфывапролджэячсмитьбю"
+_TO_CYR = str.maketrans(_LAT_KEYS, _CYR_KEYS)
+_TO_LAT = str.maketrans(_CYR_KEYS, _LAT_KEYS)
+
+@lru_cache(maxsize=8192)
+def fold_name(name: str) -> str:
+    """Нормализует название для поиска: регистр и ё/е."""
+    return name.casefold().replace("ё", "е")
+
+@lru_cache(maxsize=8192)
+def name_grams(key: str) -> frozenset[str]:
+    """Триграммы нормализованного названия."""
+    return frozenset(key[i:i + 3] for i in range(len(key) - 2))
+
+def query_variants(query: str) -> list[str]:
+    """Запрос как есть и в перепутанной раскладке (в обе стороны)."""
+    q = query.strip().casefold()
+    variants = (q, q.translate(_TO_CYR), q.translate(_TO_LAT))
+    return list(dict.fromkeys(fold_name(v) for v in variants))
+
+class NameIndex:
+    """Индекс названий: сначала префикс, потом подстрока, потом нечёткое совпадение."""
+
+    FUZZY_CANDIDATES = 50  # сколько ближайших по триграммам проверять через difflib
+
+    def __init__(self):
+        self._refs: dict[str, int] = {}           # исходное название → число упоминаний
+        self._names: dict[str, list[str]] = {}     # нормализованное → исходные названия
+        self._keys: list[str] = []                 # отсортированные нормализованные ключи
+        self._by_gram: dict[str, set[str]] = {}    # триграмма → нормализованные ключи
+
+    def add(self, name: str) -> None:
+        count = self._refs.get(name, 0)
+        self._refs[name] = count + 1
+        if count:
+            return
+        key = fold_name(name)
+        bucket = self._names.get(key)
+        if bucket is not None:
+            bucket.append(name)
+            return
+        self._names[key] = [name]
+        insort(self._keys, key)
+        for g in name_grams(key):
+            self._by_gram.setdefault(g, set()).add(key)
+
+    def discard(self, name: str) -> None:
+        count = self._refs.get(name, 0)
+        if count > 1:
+            self._refs[name] = count - 1
+            return
+        if not count:
+            return
+        del self._refs[name]
+        key = fold_name(name)
+        bucket = self._names[key]
+        bucket.remove(name)
+        if bucket:
+            return
+        del self._names[key]
+        del self._keys[bisect_left(self._keys, key)]
+        for g in name_grams(key):
+            keys = self._by_gram[g]
+            keys.discard(key)
+            if not keys:
+                del self._by_gram[g]
+
+    def _prefixed(self, prefix: str) -> list[str]:
+        i = bisect_left(self._keys, prefix)
+        found = []
+        while i < len(self._keys) and self._keys[i].startswith(prefix):
+            found.append(self._keys[i])
+            i += 1
+        return found
+
+    def _gram_hits(self, grams: frozenset[str], pool: dict[str, list[str]],
+                   indexed: bool) -> tuple[set[str], Counter]:
+        """Ключи со всеми триграммами запроса и счётчик общих триграмм для нечёткого поиска."""
+        if not indexed:
+            hits = Counter()
+            for k in pool:
+                shared = len(grams & name_grams(k))
+                if shared:
+                    hits[k] = shared
+            return {k for k, n in hits.items() if n == len(grams)}, hits
+
+        postings = sorted((self._by_gram.get(g, set()) for g in grams), key=len)
+        full = set.intersection(*postings) if postings[0] else set()
+        # слишком частые триграммы ничего не различают, их не считаем
+        common = max(200, len(self._keys) // 4)
+        hits = Counter()
+        for keys in postings:
+            if len(keys) <= common:
+                hits.update(keys)
+        return full, hits
+
+    def search(self, query: str, limit: int = 25,
+               within: list[str] | None = None) -> list[str]:
+        """Ищет по всему индексу или только среди названий `within`."""
+        indexed = within is None
+        if indexed:
+            pool = self._names
+        else:
+            pool = {}
+            for name in within:
+                pool.setdefault(fold_name(name), []).append(name)
+
+        if not query.strip():
+            keys = self._keys if indexed else pool
+            return [n for k in keys for n in pool[k]][:limit]
+
+        variants = query_variants(query)
+        if indexed:
+            prefix = {k for v in variants for k in self._prefixed(v)}
+        else:
+            prefix = {k for k in pool if any(k.startswith(v) for v in variants)}
+        ranked = sorted(prefix, key=lambda k: (len(k), k))
+        seen = set(prefix)
+
+        for v in variants:
+            if len(ranked) >= limit:
+                break
+            if len(v) < 3:
+                # коротким запросам триграммы не помогают — простой проход
+                found = [k for k in pool if k not in seen and v in k]
+            else:
+                full, hits = self._gram_hits(name_grams(v), pool, indexed)
+                found = [k for k in full if k not in seen and v in k]
+                fuzzy = [k for k, _ in hits.most_common(self.FUZZY_CANDIDATES)
+                         if k not in seen and k not in found]
+            found.sort(key=lambda k: (k.find(v), len(k), k))
+            ranked += found
+            seen.update(found)
+            if len(v) >= 3 and len(ranked) < limit:
+                for k in get_close_matches(v, fuzzy, n=limit, cutoff=0.6):
+                    seen.add(k)
+                    ranked.append(k)
+
+        return [n for k in ranked for n in pool[k]][:limit]
+
+# ---------- маршруты по карте ----------
+class RoomRouter:
+    """Кратчайшие маршруты: BFS от комнаты считается один раз и живёт до изменения карты."""
+
+    def __init__(self, graph: "RoomGraph"):
+        self.graph = graph
+        self._version = -1
+        self._trees: dict[str, dict[str, tuple[str, str] | None]] = {}
+        self._report: tuple[list[str], list[str]] | None = None
+
+    def _fresh(self) -> None:
+        if self._version != self.graph.version:
+            self._version = self.graph.version
+            self._trees.clear()
+            self._report = None
+
+    def _tree(self, source: str) -> dict[str, tuple[str, str] | None]:
+        """Дерево BFS: комната → (откуда пришли, название выхода)."""
+        self._fresh()
+        tree = self._trees.get(source)
+        if tree is None:
+            tree = {source: None}
+            queue = deque([source])
+            while queue:
+                node = queue.popleft()
+                for e in self.graph.rooms.get(node, ()):
+                    key = e.lower()
+                    if key not in tree:
+                        tree[key] = (node, e)
+                        queue.append(key)
+            self._trees[source] = tree
+        return tree
+
+    def path(self, source: str, target: str) -> list[str] | None:
+        """Выходы по кратчайшему маршруту; [] — уже на месте, None — не добраться."""
+        tree = self._tree(source.lower())
+        node = target.lower()
+        if node not in tree:
+            return None
+        hops = []
+        while tree[node] is not None:
+            node, name = tree[node]
+            hops.append(name)
+        return hops[::-1]
+
+    def report(self) -> tuple[list[str], list[str]]:
+        """(комнаты, куда не ведёт ни один выход; комнаты-ловушки, откуда не вернуться)."""
+        self._fresh()
+        if self._report is None:
+            self._report = self._build_report()
+        return self._report
+
+    def _build_report(self) -> tuple[list[str], list[str]]:
+        names = dict(self.graph.names)
+        edges: dict[str, list[str]] = {}
+        entered: set[str] = set()
+        for room, exits in self.graph.rooms.items():
+            targets = []
+            for e in exits:
+                key = e.lower()
+                names.setdefault(key, e)
+                if key != room:
+                    entered.add(key)
+                targets.append(key)
+            edges[room] = targets
+        for key in names:
+            edges.setdefault(key, [])
+
+        unreachable = sorted(names[r] for r in self.graph.rooms if r not in entered)
+
+        # компоненты сильной связности (Тарьян без рекурсии)
+        index: dict[str, int] = {}
+        low: dict[str, int] = {}
+        comp: dict[str, int] = {}
+        stack: list[str] = []
+        on_stack: set[str] = set()
+        components: list[list[str]] = []
+        counter = 0
+        for root in edges:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack.add(node)
+                if i < len(edges[node]):
+                    work.append((node, i + 1))
+                    nxt = edges[node][i]
+                    if nxt not in index:
+                        work.append((nxt, 0))
+                    elif nxt in on_stack:
+                        low[node] = min(low[node], index[nxt])
+                    continue
+                if low[node] == index[node]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        comp[member] = len(components)
+                        members.append(member)
+                        if member == node:
+                            break
+                    components.append(members)
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+
+        # ловушка — «сток» (из него нет выходов в другие компоненты), кроме основной части карты
+        main_part = max(range(len(components)), key=lambda c: len(components[c]), default=-1)
+        traps = sorted(names[m] for c, members in enumerate(components)
+                       if c != main_part and all(comp[t] == c for m in members for t in edges[m])
+                       for m in members)
+        return unreachable, traps
+
+# ---------- кэш карты комнат ----------
+SNAPSHOT_SAVE_DELAY = 5  # секунд тишины перед записью снимка карты
+
+class RoomGraph:
+    """Карта комнат из канала-источника: комната (lower) → список выходов."""
+
+    def __init__(self, snapshot_path: str):
+        self.rooms: dict[str, list[str]] = {}
+        self.names: dict[str, str] = {}   # комната (lower) → название как в списке
+        self.version = 0                  # растёт при каждом изменении карты
+        self.index = NameIndex()  # названия комнат и выходов для автокомплита
+        self.router = RoomRouter(self)
+        self.loaded = False
+        self.last_id = 0          # самое новое сообщение канала, которое мы видели
+        self.snapshot_path = snapshot_path
+        self.channel_id = 0
+        self._entries: dict[int, tuple[str, list[str]]] = {}  # id сообщения → (комната, выходы)
+        self._by_room: dict[str, set[int]] = {}               # комната (lower) → id сообщений
+        self._touched: set[int] | None = None  # изменённые событиями во время сверки
+        self._save_handle: asyncio.TimerHandle | None = None
+        self._reconcile_task: asyncio.Task | None = None
+
+    def exits(self, room: str) -> list[str]:
+        return self.rooms.get(room.lower(), [])
+
+    def set_message(self, msg_id: int, text: str) -> None:
+        """Добавляет или обновляет строку карты из сообщения."""
+        self._drop(msg_id)
+        parsed = parse_location_line(text)
+        if parsed:
+            self._put(msg_id, parsed)
+        self.last_id = max(self.last_id, msg_id)
+        self._changed(msg_id)
+
+    def remove_message(self, msg_id: int) -> None:
+        self._drop(msg_id)
+        self._changed(msg_id)
+
+    def _put(self, msg_id: int, parsed: tuple[str, list[str]]) -> None:
+        key = parsed[0].lower()
+        self._entries[msg_id] = parsed
+        self._by_room.setdefault(key, set()).add(msg_id)
+        self.index.add(parsed[0])
+        for e in parsed[1]:
+            self.index.add(e)
+        self._refresh(key)
+
+    def _drop(self, msg_id: int) -> None:
+        entry = self._entries.pop(msg_id, None)
+        if entry is None:
+            return
+        self.index.discard(entry[0])
+        for e in entry[1]:
+            self.index.discard(e)
+        key = entry[0].lower()
+        ids = self._by_room[key]
+        ids.discard(msg_id)
+        if not ids:
+            del self._by_room[key]
+        self._refresh(key)
+
+    def _refresh(self, key: str) -> None:
+        # как и при чтении истории сверху вниз — побеждает самое новое сообщение
+        ids = self._by_room.get(key)
+        if ids:
+            self.names[key], self.rooms[key] = self._entries[max(ids)]
+        else:
+            self.rooms.pop(key, None)
+            self.names.pop(key, None)
+        self.version += 1
+
+    def _changed(self, msg_id: int) -> None:
+        if self._touched is not None:
+            self._touched.add(msg_id)
+        if self.loaded and self._save_handle is None:
+            loop = asyncio.get_running_loop()
+            self._save_handle = loop.call_later(
+                SNAPSHOT_SAVE_DELAY, lambda: asyncio.create_task(self.save()))
+
+    # ----- снимок на диске -----
+    def _snapshot(self) -> dict:
+        return {
+            "channel_id": self.channel_id,
+            "last_id": self.last_id,
+            "entries": {str(i): [room, exits] for i, (room, exits) in self._entries.items()},
+        }
+
+    def _write(self, data: dict) -> None:
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.snapshot_path)
+
+    def restore(self) -> bool:
+        """Подхватывает снимок с диска; False — снимка нет или он от другого канала."""
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("channel_id") != self.channel_id:
+            return False
+        for msg_id, (room, exits) in data["entries"].items():
+            self._put(int(msg_id), (room, exits))
+        self.last_id = data["last_id"]
+        return True
+
+    def save_now(self) -> None:
+        """Синхронная запись снимка — при выключении бота."""
+        if self.loaded:
+            self._write(self._snapshot())
+
+    async def save(self) -> None:
+        self._save_handle = None
+        if self.loaded:
+            await asyncio.to_thread(self._write, self._snapshot())
+
+    # ----- загрузка -----
+    async def start(self, channel: discord.TextChannel) -> None:
+        """Снимок + догрузка новых сообщений; полная сверка уходит в фон."""
+        self.channel_id = channel.id
+        if not self.restore():
+            await self.load(channel)
+            await self.save()
+            return
+        await self.catch_up(channel)
+        self.loaded = True
+        self._start_reconcile(channel)
+
+    async def resync(self, channel: discord.TextChannel) -> None:
+        """Новая сессия gateway: события за обрыв потеряны — догружаем новое и заново сверяем канал."""
+        await self.catch_up(channel)
+        self._start_reconcile(channel)
+
+    async def catch_up(self, channel: discord.TextChannel) -> None:
+        """Сообщения новее последнего увиденного."""
+        async for msg in iter_history(channel, after=discord.Object(id=self.last_id),
+                                      priority=PRIO_PERMISSIONS):
+            if msg.id not in self._entries:
+                self.set_message(msg.id, msg.content)
+
+    def _start_reconcile(self, channel: discord.TextChannel) -> None:
+        # незаконченная сверка устарела; новая начнётся, когда та снимет свою пометку событий
+        previous = self._reconcile_task
+        if previous is not None and not previous.done():
+            previous.cancel()
+        self._reconcile_task = asyncio.create_task(self._reconcile_after(previous, channel))
+
+    async def _reconcile_after(self, previous: asyncio.Task | None, channel: discord.TextChannel) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.reconcile(channel)
+
+    async def load(self, channel: discord.TextChannel) -> None:
+        """Полная загрузка карты из истории канала."""
+        async for msg in iter_history(channel):
+            if msg.id not in self._entries:
+                self.set_message(msg.id, msg.content)
+        self.loaded = True
+
+    async def reconcile(self, channel: discord.TextChannel) -> None:
+        """Фоновая сверка со всем каналом: правки и удаления, пропущенные пока бот был выключен."""
+        upper = self.last_id
+        self._touched = set()
+        try:
+            seen: dict[int, str] = {}
+            async for msg in iter_history(channel, before=discord.Object(id=upper + 1),
+                                          priority=PRIO_LOG):
+                seen[msg.id] = msg.content
+            # события, пришедшие во время сверки, новее прочитанного — их не трогаем
+            for msg_id in [i for i in self._entries if i <= upper and i not in seen]:
+                if msg_id not in self._touched:
+                    self.remove_message(msg_id)
+            for msg_id, text in seen.items():
+                if msg_id not in self._touched and \
+                   parse_location_line(text) != self._entries.get(msg_id):
+                    self.set_message(msg_id, text)
+        finally:
+            self._touched = None
+
+# ---------- индекс каналов ----------
+class ChannelIndex:
+    """Текстовые каналы по (категория, название) — цель /move без перебора всей гильдии."""
+
+    def __init__(self):
+        # одноимённых каналов в категории может быть несколько: ключ → {id канала: канал}
+        self._by_key: dict[tuple[int | None, str], dict[int, discord.TextChannel]] = {}
+        self._keys: dict[int, tuple[int | None, str]] = {}  # id канала → ключ
+
+    @staticmethod
+    def key(category_id: int | None, name: str) -> tuple[int | None, str]:
+        return category_id, name.casefold()
+
+    def get(self, category_id: int | None, name: str) -> discord.TextChannel | None:
+        channels = self._by_key.get(self.key(category_id, name))
+        if not channels:
+            return None
+        if len(channels) == 1:
+            return next(iter(channels.values()))
+        # как при поиске по списку каналов — верхний в категории
+        return min(channels.values(), key=lambda c: (c.position, c.id))
+
+    def add(self, channel: discord.abc.GuildChannel) -> None:
+        self.remove(channel.id)
+        if not isinstance(channel, discord.TextChannel):
+            return
+        key = self.key(channel.category_id, channel.name)
+        self._by_key.setdefault(key, {})[channel.id] = channel
+        self._keys[channel.id] = key
+
+    def remove(self, channel_id: int) -> None:
+        key = self._keys.pop(channel_id, None)
+        channels = self._by_key.get(key)
+        if channels is None:
+            return
+        channels.pop(channel_id, None)
+        if not channels:
+            del self._by_key[key]
+
+    def load(self, guild: discord.Guild) -> None:
+        for channel in guild.text_channels:
+            self.add(channel)
+
+channel_index = ChannelIndex()
+
+def missing_exits(graph: RoomGraph, category_id: int) -> list[tuple[str, str]]:
+    """Выходы из карты, для которых в категории нет канала: [(комната, выход)]."""
+    return [(room, e) for room, exits in graph.rooms.items()
+            for e in exits if channel_index.get(category_id, e) is None]
+
+# ---------- где находятся игроки ----------
+LOCATIONS_SAVE_DELAY = 5         # секунд тишины перед записью на диск
+RECONCILE_INTERVAL = 6 * 60 * 60  # секунд между фоновыми чистками прав
+RECONCILE_BATCH = 20             # удалений прав за один заход
+
+def _is_player(target) -> bool:
+    if isinstance(target, discord.Object):
+        return target.type is discord.User
+    return isinstance(target, (discord.Member, discord.User)) and not target.bot
+
+# ровно те права, которые когда-либо ставил /move: «пришёл» и прежний «ушёл»
+MOVE_PRESENT = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+MOVE_LEFT = discord.PermissionOverwrite(read_messages=False, send_messages=False)
+
+def _is_move_overwrite(overwrite: discord.PermissionOverwrite) -> bool:
+    """Права, которые ставит /move, а не ручные настройки мастеров (мут, бан, отдельный доступ)."""
+    return overwrite == MOVE_PRESENT or overwrite == MOVE_LEFT
+
+class LocationStore:
+    """Где сейчас каждый игрок: участник → канал комнаты. У игрока одно право «присутствия» — в этом канале."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.where: dict[int, int] = {}
+        self.loaded = False
+        self._save_handle: asyncio.TimerHandle | None = None
+        self._task: asyncio.Task | None = None
+
+    def set(self, member_id: int, channel_id: int) -> int | None:
+        """Запоминает комнату игрока и возвращает прежнюю."""
+        previous = self.where.get(member_id)
+        self.where[member_id] = channel_id
+        self._changed()
+        return previous
+
+    def forget(self, member_id: int) -> None:
+        if self.where.pop(member_id, None) is not None:
+            self._changed()
+
+    def by_channel(self) -> dict[int, list[int]]:
+        rooms: dict[int, list[int]] = defaultdict(list)
+        for member_id, channel_id in self.where.items():
+            rooms[channel_id].append(member_id)
+        return rooms
+
+    # ----- хранение -----
+    def _changed(self) -> None:
+        if self.loaded and self._save_handle is None:
+            loop = asyncio.get_running_loop()
+            self._save_handle = loop.call_later(
+                LOCATIONS_SAVE_DELAY, lambda: asyncio.create_task(self.save()))
+
+    def _write(self, data: dict) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def restore(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.where = {int(m): c for m, c in data.items()} | self.where
+        self.loaded = True
+
+    def save_now(self) -> None:
+        if self.loaded:
+            self._write({str(m): c for m, c in self.where.items()})
+
+    async def save(self) -> None:
+        self._save_handle = None
+        if self.loaded:
+            await asyncio.to_thread(self._write, {str(m): c for m, c in self.where.items()})
+
+    # ----- сверка с правами каналов -----
+    async def evict(self, channel: discord.abc.GuildChannel, member_id: int) -> bool:
+        """Снимает право игрока в канале, если он за это время туда не вернулся."""
+        if self.where.get(member_id) == channel.id:
+            return False
+        try:
+            await rest.call(PRIO_LOG, "permissions", channel.id,
+                            bot.http.delete_channel_permissions, channel.id, member_id,
+                            reason="Игрок уже в другой комнате")
+        except discord.NotFound:
+            pass
+        return True
+
+    async def reconcile(self, guild: discord.Guild, category_id: int) -> tuple[int, int, int]:
+        """Удаляет устаревшие права игроков в комнатах категории: (снято, найдено игроков, неясных)."""
+        category = guild.get_channel(category_id)
+        if not isinstance(category, discord.CategoryChannel):
+            return 0, 0, 0
+        rooms = {channel.id for channel in category.text_channels}
+        present: dict[int, list[discord.TextChannel]] = defaultdict(list)
+        stale: list[tuple[discord.TextChannel, int]] = []
+        for channel in category.text_channels:
+            for target, overwrite in channel.overwrites.items():
+                if not _is_player(target) or not _is_move_overwrite(overwrite):
+                    continue
+                if overwrite.read_messages:
+                    present[target.id].append(channel)
+                else:
+                    stale.append((channel, target.id))  # запреты от прежнего /move
+        adopted = ambiguous = 0
+        for member_id, channels in present.items():
+            where = self.where.get(member_id)
+            if where is None or where not in rooms:
+                # игрока нет в хранилище — верим правам, если комната одна
+                if len(channels) != 1:
+                    ambiguous += 1
+                    continue
+                self.set(member_id, channels[0].id)
+                adopted += 1
+                continue
+            stale += [(channel, member_id) for channel in channels if channel.id != where]
+        # права сняли вручную или комнату удалили — игрок вне игры
+        for member_id in [m for m in self.where if m not in present]:
+            self.forget(member_id)
+
+        removed = 0
+        for i in range(0, len(stale), RECONCILE_BATCH):
+            results = await asyncio.gather(
+                *(self.evict(channel, member_id) for channel, member_id in stale[i:i + RECONCILE_BATCH]),
+                return_exceptions=True)
+            removed += sum(1 for r in results if r is True)
+        metrics.inc("fler_overwrites_removed_total", removed)
+        return removed, adopted, ambiguous
+
+    def start(self, guild: discord.Guild, category_id: int) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(guild, category_id))
+
+    async def _run(self, guild: discord.Guild, category_id: int) -> None:
+        while True:
+            try:
+                removed, adopted, ambiguous = await self.reconcile(guild, category_id)
+                if removed or ambiguous:
+                    await log_action(None, bot.user,
+                                     f"Сверка прав комнат: снято {removed}, найдено игроков {adopted}",
+                                     extra=f" неясно, где находятся: {ambiguous}" if ambiguous else "",
+                                     level="warn" if ambiguous else "success", guild=guild)
+            except Exception as e:
+                await log_action(None, bot.user, f"Сверка прав комнат не удалась: {e}",
+                                 level="error", guild=guild)
+            await asyncio.sleep(RECONCILE_INTERVAL)
+
 # ---------- автокомплит ----------
+MOVE_ROUTE_PARAM = "маршрут"  # имя параметра route у /move в Discord — под ним он и лежит в namespace
+
 async def room_autocomplete(interaction: discord.Interaction, current: str):
-    channel = bot.get_channel(ROOMS_SOURCE_CHANNEL_ID)
-    if not channel or not isinstance(interaction.channel, discord.TextChannel):
+    if not isinstance(interaction.channel, discord.TextChannel):
         return []
 
-    # определяем текущую комнату по названию канала
-    current_room = interaction.channel.name
-    exits = []
-
-    async for msg in channel.history(limit=None):
-        parsed = parse_location_line(msg.content)
-        if parsed and parsed[0].lower() == current_room.lower():
-            exits = [e for e in parsed[1] if current.lower() in e.lower()]
-            break
+    # определяем текущую комнату по названию канала; с маршрутом подходит любая комната
+    graph = guilds.get(interaction.guild_id).rooms
+    within = None if getattr(interaction.namespace, MOVE_ROUTE_PARAM, False) \
+        else graph.exits(interaction.channel.name)
+    with metrics.timer("fler_autocomplete_seconds"):
+        exits = graph.index.search(current, within=within)
+
+    return [app_commands.Choice(name=e, value=e) for e in exits]
+
+async def any_room_autocomplete(interaction: discord.Interaction, current: str):
+    with metrics.timer("fler_autocomplete_seconds"):
+        rooms = guilds.get(interaction.guild_id).rooms.index.search(current)
+    return [app_commands.Choice(name=r, value=r) for r in rooms]
+
+# ---------- очередь логов ----------
+LOG_BATCH = 10            # эмбедов в одном сообщении (лимит Discord)
+LOG_BATCH_CHARS = 6000    # символов во всех эмбедах одного сообщения (лимит Discord)
+LOG_RETRIES = 5
+LOG_FLUSH_TIMEOUT = 5     # секунд на отправку остатка логов при выключении
+
+class LogPipeline:
+    """Фоновая отправка логов: пачки до 10 эмбедов и 6000 символов в канал логов, ЛС — отдельными задачами."""
+
+    def __init__(self, guild_id: int, channel_id: int):
+        self.guild_id = guild_id      # 0 — общие логи бота
+        self.channel_id = channel_id
+        self.queue: asyncio.Queue[discord.Embed] = asyncio.Queue()
+        self._worker: asyncio.Task | None = None
+        self._dm_tasks: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def put(self, embed: discord.Embed,
+            dm_to: discord.Member | discord.User | None = None) -> None:
+        self.queue.put_nowait(embed)
+        if dm_to is not None:
+            task = asyncio.create_task(self._send_dm(dm_to, embed))
+            self._dm_tasks.add(task)
+            task.add_done_callback(self._dm_tasks.discard)
+
+    async def _run(self):
+        carry = None  # не влезший в прошлую пачку эмбед открывает следующую
+        while True:
+            batch = [carry or await self.queue.get()]
+            carry = None
+            size = len(batch[0])
+            while len(batch) < LOG_BATCH and not self.queue.empty():
+                embed = self.queue.get_nowait()
+                if size + len(embed) > LOG_BATCH_CHARS:
+                    carry = embed
+                    break
+                batch.append(embed)
+                size += len(embed)
+            try:
+                await self._send(batch)
+            except Exception:
+                pass  # лог не должен ронять воркер
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _send(self, embeds: list[discord.Embed]):
+        await bot.wait_until_ready()
+        log_ch = bot.get_channel(self.channel_id)
+        # канал логов по умолчанию не должен получать логи чужих серверов
+        if not log_ch or (self.guild_id and log_ch.guild.id != self.guild_id):
+            return
+        delay = 1
+        for _ in range(LOG_RETRIES):
+            try:
+                await rest.call(PRIO_LOG, "send", log_ch.id, log_ch.send, embeds=embeds)
+                return
+            except discord.HTTPException as e:
+                # повторяем только упор в лимит и ошибки сервера
+                if e.status != 429 and e.status < 500:
+                    if len(embeds) == 1:
+                        raise
+                    # пачку отверг один эмбед — остальные отправляем по одному
+                    for embed in embeds:
+                        try:
+                            await self._send([embed])
+                        except discord.HTTPException:
+                            pass
+                    return
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    @staticmethod
+    async def _send_dm(user: discord.Member | discord.User, embed: discord.Embed):
+        try:
+            await rest.call(PRIO_LOG, "dm", None, user.send, embed=embed)
+        except discord.HTTPException:
+            pass
 
-    return [app_commands.Choice(name=e, value=e) for e in exits][:25]
+    async def flush(self, timeout: float) -> None:
+        """Ждёт, пока очередь опустеет, но не дольше timeout секунд."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self._dm_tasks:
+            await asyncio.wait(self._dm_tasks, timeout=max(0, deadline - loop.time()))
+
+# ---------- журнал действий ----------
+AUDIT_FLUSH_INTERVAL = 1.0  # секунд между записями накопленного в базу
+AUDIT_BATCH = 500           # записей, после которых пишем не дожидаясь таймера
+AUDIT_QUERY_LIMIT = 20
+
+# команда, в рамках которой идёт действие; задачи очистки наследуют её от команды
+current_command: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_command", default=None)
+
+AUDIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit (
+    id         INTEGER PRIMARY KEY,
+    ts         REAL    NOT NULL,
+    guild_id   INTEGER NOT NULL,
+    actor_id   INTEGER,
+    actor      TEXT,
+    command    TEXT,
+    channel_id INTEGER,
+    level      TEXT    NOT NULL,
+    deleted    INTEGER,
+    skipped    INTEGER,
+    failed     INTEGER,
+    source_id  INTEGER,
+    target_id  INTEGER,
+    text       TEXT    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS audit_guild_ts   ON audit (guild_id, ts);
+CREATE INDEX IF NOT EXISTS audit_actor_ts   ON audit (guild_id, actor_id, ts);
+CREATE INDEX IF NOT EXISTS audit_channel_ts ON audit (guild_id, channel_id, ts);
+CREATE INDEX IF NOT EXISTS audit_command_ts ON audit (guild_id, command, ts);
+"""
+AUDIT_COLUMNS = ("ts", "guild_id", "actor_id", "actor", "command", "channel_id", "level",
+                 "deleted", "skipped", "failed", "source_id", "target_id", "text")
+
+class AuditStore:
+    """Журнал действий в SQLite (WAL): запись пачками в отдельном потоке, запросы по индексам."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db: sqlite3.Connection | None = None
+        self._buffer: list[tuple] = []
+        self._lock = asyncio.Lock()   # одно соединение — по очереди из потоков
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+        self._closing = False
+
+    def _open(self) -> None:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(AUDIT_SCHEMA)
+        self.db = db
+
+    async def start(self) -> None:
+        if self.db is None:
+            await asyncio.to_thread(self._open)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def record(self, **row) -> None:
+        if self.db is None:
+            return
+        self._buffer.append(tuple(row.get(column) for column in AUDIT_COLUMNS))
+        if len(self._buffer) >= AUDIT_BATCH:
+            self._wakeup.set()
+
+    def _insert(self, rows: list[tuple]) -> None:
+        with self.db:
+            self.db.executemany(
+                f"INSERT INTO audit ({', '.join(AUDIT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(AUDIT_COLUMNS))})", rows)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._buffer or self.db is None:
+                return
+            rows, self._buffer = self._buffer, []
+            try:
+                await asyncio.to_thread(self._insert, rows)
+            except sqlite3.Error:
+                # например, «database is locked» от соседнего процесса — записи не теряем
+                self._buffer[:0] = rows
+                raise
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), AUDIT_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logging.getLogger("fler.audit").warning("Не удалось записать журнал: %s", e)
+
+    async def close(self) -> None:
+        """Дописывает остаток и закрывает базу — при выключении бота."""
+        if self.db is None:
+            return
+        # воркер может быть посреди записи в потоке — даём ему закончить, а не отменяем
+        self._closing = True
+        self._wakeup.set()
+        if self._worker is not None:
+            await asyncio.gather(self._worker, return_exceptions=True)
+        async with self._lock:
+            if self._buffer:
+                rows, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._insert, rows)
+            await asyncio.to_thread(self.db.close)
+            self.db = None
+
+    def _select(self, sql: str, params: list) -> list[sqlite3.Row]:
+        cursor = self.db.execute(sql, params)
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchall()
+
+    async def query(self, guild_id: int, *, actor_id: int | None = None,
+                    channel_id: int | None = None, command: str | None = None,
+                    since: float | None = None, until: float | None = None,
+                    limit: int = AUDIT_QUERY_LIMIT) -> list[sqlite3.Row]:
+        """Последние записи сервера по фильтрам, новые сверху."""
+        await self.flush()  # только что сделанное тоже должно найтись
+        where, params = ["guild_id = ?"], [guild_id]
+        for column, value in (("actor_id", actor_id), ("channel_id", channel_id), ("command", command)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            params.append(until)
+        sql = f"SELECT * FROM audit WHERE {' AND '.join(where)} ORDER BY ts DESC LIMIT ?"
+        async with self._lock:
+            if self.db is None:
+                return []
+            return await asyncio.to_thread(self._select, sql, params + [limit])
+
+audit = AuditStore(AUDIT_DB_PATH)
+metrics.gauge("fler_audit_buffer", lambda: len(audit._buffer))
 
 async def log_action(channel: discord.TextChannel | None,
-                     author: discord.Member | discord.User,
+                     author: discord.Member | discord.User | discord.Object,
                      description: str,
                      extra: str = "",
                      level: str = "success",
-                     send_dm: bool = True):
+                     send_dm: bool = True,
+                     guild: discord.Guild | None = None,
+                     *,
+                     stats: "PurgeStats | None" = None,
+                     source: discord.abc.Snowflake | None = None,
+                     target: discord.abc.Snowflake | None = None):
     color_map = {"success": 0x1e8e3e, "warn": 0xff7800, "error": 0x990000}
 
     compact = (
@@ -75,15 +1350,693 @@ async def log_action(channel: discord.TextChannel | None,
                           color=color_map[level],
                           timestamp=datetime.now(timezone.utc))
 
-    log_ch = bot.get_channel(LOG_CHANNEL_ID)
-    if log_ch:
-        await log_ch.send(embed=embed)
+    # отправка идёт в фоне — команда не ждёт канал логов и ЛС;
+    # у каждого сервера своя очередь, логи без сервера уходят в общий канал
+    guild = guild or getattr(channel, "guild", None) or getattr(author, "guild", None)
+    dm_to = author if send_dm and author != bot.user else None
+    guilds.get(guild.id if guild else None).log.put(embed, dm_to)
+
+    audit.record(ts=time.time(), guild_id=guild.id if guild else 0,
+                 actor_id=getattr(author, "id", None), actor=getattr(author, "display_name", None),
+                 command=current_command.get(),
+                 channel_id=getattr(channel, "id", None) or getattr(source, "id", None),
+                 level=level, deleted=stats and stats.deleted, skipped=stats and stats.skipped,
+                 failed=stats and stats.failed, source_id=getattr(source, "id", None),
+                 target_id=getattr(target, "id", None), text=compact)
+
+# ---------- движок удаления ----------
+# bulk delete принимает только сообщения младше 14 дней; берём небольшой запас
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_CHUNK = 100
+
+@dataclass
+class PurgeStats:
+    deleted: int = 0
+    skipped: int = 0   # уже удалены или повторяются
+    failed: int = 0
+
+    def __str__(self) -> str:
+        return f"удалено {self.deleted}, пропущено {self.skipped}, ошибок {self.failed}"
+
+    @property
+    def level(self) -> str:
+        return "warn" if self.failed else "success"
+
+async def delete_messages(channel: discord.abc.Messageable,
+                          targets: Iterable[discord.abc.Snowflake],
+                          stats: PurgeStats | None = None) -> PurgeStats:
+    """Удаляет сообщения: свежие — пачками по 100, старше 14 дней — по одному."""
+    stats = stats or PurgeStats()
+    border = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    seen: set[int] = set()
+    fresh, old = [], []
+    for target in targets:
+        if target.id in seen:
+            stats.skipped += 1
+            continue
+        seen.add(target.id)
+        if discord.utils.snowflake_time(target.id) > border:
+            fresh.append(target)
+        else:
+            old.append(target)
 
-    if send_dm and author != bot.user:
+    for i in range(0, len(fresh), BULK_DELETE_CHUNK):
+        chunk = fresh[i:i + BULK_DELETE_CHUNK]
+        if len(chunk) == 1:
+            old.extend(chunk)  # bulk delete требует минимум два сообщения
+            continue
         try:
-            await author.send(embed=embed)
+            await rest.call(PRIO_BULK, "bulk_delete", channel.id, channel.delete_messages, chunk)
+            stats.deleted += len(chunk)
+            metrics.inc("fler_messages_deleted_total", len(chunk), mode="bulk")
         except discord.Forbidden:
-            pass
+            stats.failed += len(chunk)
+        except discord.HTTPException:
+            old.extend(chunk)  # пачка не прошла целиком — добиваем по одному
+
+    # параллельность одиночных удалений ограничивает планировщик (потолок на канал)
+    async def delete_one(target: discord.abc.Snowflake):
+        try:
+            await rest.call(PRIO_BULK, "delete", channel.id,
+                            channel.get_partial_message(target.id).delete)
+        except discord.NotFound:
+            stats.skipped += 1
+        except discord.HTTPException:
+            stats.failed += 1
+        else:
+            stats.deleted += 1
+            metrics.inc("fler_messages_deleted_total", mode="single")
+
+    await asyncio.gather(*(delete_one(t) for t in old))
+    return stats
+
+# ---------- потоковый отбор сообщений ----------
+# предикат получает id автора и уже нормализованный текст сообщения
+MessagePredicate = Callable[[int, str], bool]
+
+def normalize_text(text: str) -> str:
+    """Текст сообщения в виде для сравнения с фразами: NFKC, регистр, ё/е."""
+    return unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+
+def any_message(author_id: int, text: str) -> bool:
+    return True
+
+def by_author(member_id: int) -> MessagePredicate:
+    return lambda author_id, text: author_id == member_id
+
+REGEX_PREFIX = "re:"  # фраза с таким префиксом — регулярное выражение
+_QUOTED = re.compile(r'"([^"]*)"')
+_QUOTED_LIST = re.compile(r'(?:"[^"]*"\s*)+')
+
+def parse_phrases(raw: str) -> list[str]:
+    """`"фраза1" "фраза2" "re:шаблон"` → список фраз; без кавычек весь текст — одна фраза.
+
+    Текст после кавычек, непарная кавычка или одни пустые фразы — BadArgument: молча терять часть условия нельзя.
+    """
+    raw = raw.strip()
+    if not raw.startswith('"'):
+        return [raw]
+    if not _QUOTED_LIST.fullmatch(raw):
+        raise commands.BadArgument("каждая фраза — в своих кавычках, без текста между ними")
+    phrases = [p for p in _QUOTED.findall(raw) if p.strip()]
+    if not phrases:
+        raise commands.BadArgument("все фразы пустые")
+    return phrases
+
+def _fold_pattern(pattern: str) -> str:
+    # текст сообщений приходит уже с ё→е — так же приводим и шаблон (регистр учитывает флаг i)
+    return pattern.replace("ё", "е").replace("Ё", "Е")
+
+class PhraseMatcher:
+    """Все фразы одной командой — в одно выражение, текст проверяется за один проход.
+
+    Регулярки компилируются по отдельности: у каждой свои группы и обратные ссылки.
+    """
+
+    def __init__(self, phrases: list[str]):
+        literals = {normalize_text(p) for p in phrases if not p.startswith(REGEX_PREFIX)}
+        self.literals = frozenset(literals)
+        # длинные фразы раньше коротких — при общем начале совпадёт более длинная
+        parts = [re.escape(l) for l in sorted(literals, key=len, reverse=True)]
+        self.any = re.compile("|".join(parts)) if parts else None
+        self.regexes = [re.compile(_fold_pattern(p[len(REGEX_PREFIX):]), re.IGNORECASE)
+                        for p in phrases if p.startswith(REGEX_PREFIX)]
+
+    def contains(self, text: str) -> bool:
+        return (self.any is not None and self.any.search(text) is not None) or \
+            any(regex.search(text) is not None for regex in self.regexes)
+
+    def equals(self, text: str) -> bool:
+        return text in self.literals or \
+            any(regex.fullmatch(text) is not None for regex in self.regexes)
+
+def _phrase_list(phrases: list[str] | str) -> list[str]:
+    # задачи, сохранённые до появления списков, хранят одну строку
+    return [phrases] if isinstance(phrases, str) else phrases
+
+def containing(phrases: list[str] | str) -> MessagePredicate:
+    matcher = PhraseMatcher(_phrase_list(phrases))
+    return lambda author_id, text: matcher.contains(text)
+
+def exactly(phrases: list[str] | str) -> MessagePredicate:
+    matcher = PhraseMatcher(_phrase_list(phrases))
+    return lambda author_id, text: matcher.equals(text)
+
+def describe_phrases(phrases: list[str]) -> str:
+    return ", ".join(f"«{p}»" for p in phrases)
+
+def _snowflake(value: int | None) -> discord.Object | None:
+    return discord.Object(id=value) if value is not None else None
+
+# ---------- локальный индекс сообщений ----------
+INDEX_BACKFILL_LIMIT = 50_000  # сообщений истории, которые индекс дочитывает при старте
+INDEX_MAX_MESSAGES = 200_000   # больше не держим — старые вытесняются
+INDEX_COMPACT_MIN = 1_024      # удалённых записей, после которых стоит ужать массивы
+
+class MessageIndex:
+    """Сообщения канала в массивах по возрастанию id: id (в нём же время), автор, нормализованный текст.
+
+    Покрывает все сообщения с id >= floor; удалённые помечаются автором 0 до ужатия.
+    """
+
+    def __init__(self):
+        self.ids = array("Q")
+        self.authors = array("Q")
+        self.texts: list[str] = []
+        self.dead = 0
+        self.floor = 0
+        self.ready = False
+        self._built = False  # история дочитана; после обрыва связи хватит догнать пропущенное
+        self._task: asyncio.Task | None = None
+        # что пришло событиями во время дочитывания, но относится к ещё не прочитанной истории
+        self._early_deletes: set[int] | None = None
+        self._early_edits: dict[int, str] | None = None
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.dead
+
+    def _find(self, msg_id: int) -> int | None:
+        pos = bisect_left(self.ids, msg_id)
+        return pos if pos < len(self.ids) and self.ids[pos] == msg_id else None
+
+    def add(self, msg_id: int, author_id: int, content: str) -> None:
+        text = normalize_text(content)
+        if not self.ids or msg_id > self.ids[-1]:
+            self.ids.append(msg_id)
+            self.authors.append(author_id)
+            self.texts.append(text)
+        else:
+            pos = bisect_left(self.ids, msg_id)
+            if pos < len(self.ids) and self.ids[pos] == msg_id:
+                return
+            self.ids.insert(pos, msg_id)
+            self.authors.insert(pos, author_id)
+            self.texts.insert(pos, text)
+        if len(self.ids) > INDEX_MAX_MESSAGES:
+            self._trim()
+
+    def edit(self, msg_id: int, content: str) -> None:
+        pos = self._find(msg_id)
+        if pos is not None:
+            if self.authors[pos]:
+                self.texts[pos] = normalize_text(content)
+        elif self._early_edits is not None:
+            self._early_edits[msg_id] = content
+
+    def remove(self, msg_id: int) -> None:
+        pos = self._find(msg_id)
+        if pos is None:
+            if self._early_deletes is not None:
+                self._early_deletes.add(msg_id)
+            return
+        if self.authors[pos]:
+            self.authors[pos] = 0
+            self.texts[pos] = ""
+            self.dead += 1
+            if self.dead >= INDEX_COMPACT_MIN and self.dead * 2 > len(self.ids):
+                self._compact()
+
+    def _compact(self) -> None:
+        keep = [i for i, author in enumerate(self.authors) if author]
+        self.ids = array("Q", (self.ids[i] for i in keep))
+        self.authors = array("Q", (self.authors[i] for i in keep))
+        self.texts = [self.texts[i] for i in keep]
+        self.dead = 0
+
+    def _trim(self) -> None:
+        drop = len(self.ids) - INDEX_MAX_MESSAGES
+        self.dead -= sum(1 for author in self.authors[:drop] if not author)
+        del self.ids[:drop], self.authors[:drop], self.texts[:drop]
+        self.floor = self.ids[0]
+
+    def count(self, after: int | None, before: int | None) -> int:
+        """Живых сообщений в окне (after, before)."""
+        hi = bisect_left(self.ids, before) if before is not None else len(self.ids)
+        lo = bisect_right(self.ids, after) if after is not None else 0
+        return sum(1 for author in self.authors[lo:hi] if author)
+
+    def find(self, predicate: MessagePredicate, before: int | None, after: int | None,
+             limit: int) -> tuple[list[int], int]:
+        """(id подходящих сообщений от новых к старым, сколько просмотрено) в окне (after, before)."""
+        hi = bisect_left(self.ids, before) if before is not None else len(self.ids)
+        lo = bisect_right(self.ids, after) if after is not None else 0
+        found: list[int] = []
+        scanned = 0
+        ids, authors, texts = self.ids, self.authors, self.texts
+        for pos in range(hi - 1, lo - 1, -1):
+            author = authors[pos]
+            if not author:
+                continue
+            scanned += 1
+            if predicate(author, texts[pos]):
+                found.append(ids[pos])
+                if len(found) >= limit:
+                    break
+        return found, scanned
+
+    def start(self, channel: discord.TextChannel) -> None:
+        """Первый старт дочитывает историю; каждый следующий (новая сессия gateway) — пропущенное за обрыв."""
+        self.ready = False
+        self._task = asyncio.create_task(self._sync(channel, self._task))
+
+    async def _sync(self, channel: discord.TextChannel, previous: asyncio.Task | None) -> None:
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        if self._built:
+            await self.catch_up(channel)
+        else:
+            await self.backfill(channel)
+
+    def _reset(self) -> None:
+        self.ids, self.authors, self.texts = array("Q"), array("Q"), []
+        self.dead = self.floor = 0
+        self._built = False
+
+    async def catch_up(self, channel: discord.TextChannel) -> None:
+        """Дочитывает сообщения новее последнего известного id; пока не дочитал, индексу не верим.
+
+        Удаления старых сообщений за время обрыва отсюда не видны — очистка засчитывает только удалённое.
+        """
+        after = discord.Object(id=self.ids[-1] if self.ids else self.floor)
+        self._early_deletes, self._early_edits = set(), {}
+        missed: list[tuple[int, int, str]] = []
+        try:
+            async for page in history_pages(channel, after=after, priority=PRIO_LOG):
+                missed.extend((msg.id, msg.author.id, msg.content) for msg in page)
+                if len(missed) >= INDEX_BACKFILL_LIMIT:
+                    break
+            else:
+                for msg_id, author_id, content in reversed(missed):
+                    if msg_id not in self._early_deletes:
+                        self.add(msg_id, author_id, self._early_edits.get(msg_id, content))
+                self.ready = True
+                return
+        except BaseException:
+            self._reset()  # с дырой индекс не нужен — соберём заново при следующем старте
+            raise
+        finally:
+            self._early_deletes = self._early_edits = None
+        # обрыв длиннее, чем дочитываем при старте, — проще собрать индекс заново
+        self._reset()
+        await self.backfill(channel)
+
+    async def backfill(self, channel: discord.TextChannel) -> None:
+        """Однократно дочитывает историю до INDEX_BACKFILL_LIMIT; новые сообщения тем временем идут событиями."""
+        upper = discord.utils.time_snowflake(discord.utils.utcnow())
+        self._early_deletes, self._early_edits = set(), {}
+        ids, authors, texts = array("Q"), array("Q"), []
+        try:
+            async for page in history_pages(channel, discord.Object(id=upper), priority=PRIO_LOG):
+                for msg in page:
+                    ids.append(msg.id)
+                    authors.append(msg.author.id)
+                    texts.append(msg.content)
+                if len(ids) >= INDEX_BACKFILL_LIMIT:
+                    break
+            complete = len(ids) < INDEX_BACKFILL_LIMIT
+            live = (array("Q", self.ids), array("Q", self.authors), self.texts)
+            self.ids, self.authors, self.texts, self.dead = array("Q"), array("Q"), [], 0
+            for i in range(len(ids) - 1, -1, -1):
+                if ids[i] in self._early_deletes or (live[0] and ids[i] >= live[0][0]):
+                    continue
+                self.ids.append(ids[i])
+                self.authors.append(authors[i])
+                self.texts.append(normalize_text(self._early_edits.get(ids[i], texts[i])))
+            self.ids.extend(live[0])
+            self.authors.extend(live[1])
+            self.texts.extend(live[2])
+            self.dead = sum(1 for author in self.authors if not author)
+            self.floor = 0 if complete or not self.ids else self.ids[0]
+            self._built = self.ready = True
+        finally:
+            self._early_deletes = self._early_edits = None
+
+# ---------- задачи очистки ----------
+JOB_PROGRESS_INTERVAL = 10  # секунд между обновлениями сообщения о ходе очистки
+MAX_PARALLEL_JOBS = 2       # одновременно выполняемых очисток на весь процесс
+
+# места общие для всех серверов; первым получает сервер, у которого сейчас меньше идущих очисток
+purge_slots = PrioritySlots(MAX_PARALLEL_JOBS)
+
+@dataclass
+class PurgeJob:
+    """Задача очистки. Хранится на диске, чтобы продолжиться после перезапуска."""
+    kind: str                   # all | user | contains | exact
+    count: int
+    summary: str                # что удаляем — для лога и статуса
+    arg: int | list[str] | None = None   # участник или фразы
+    id: int = 0
+    guild_id: int = 0
+    channel_id: int = 0
+    author_id: int = 0
+    before: int | None = None   # курсор: всё, что новее, уже обработано
+    after: int | None = None    # нижняя граница (не включительно)
+    scanned: int = 0
+    matched: int = 0
+    state: str = "в очереди"
+    status_message_id: int | None = None
+    command: str = ""           # команда, которой поставлена задача — для журнала
+    stats: PurgeStats = field(default_factory=PurgeStats)
+    saved: dict | None = field(default=None, repr=False)  # последний чекпоинт — его и пишем на диск
+
+    def predicate(self) -> MessagePredicate:
+        if self.kind == "user":
+            return by_author(self.arg)
+        if self.kind == "contains":
+            return containing(self.arg)
+        if self.kind == "exact":
+            return exactly(self.arg)
+        return any_message
+
+    def progress(self) -> str:
+        return (f"Очистка #{self.id} ({self.state}): {self.summary} — "
+                f"просмотрено {self.scanned}, найдено {self.matched}/{self.count}, {self.stats}")
+
+    def mark(self) -> None:
+        """Запоминает курсор вместе со счётчиками: пока пачка удаляется, живые поля расходятся."""
+        self.saved = {"before": self.before, "scanned": self.scanned,
+                      "matched": self.matched, "stats": asdict(self.stats)}
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.update(data.pop("saved") or {})
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PurgeJob":
+        data = dict(data)
+        data.pop("saved", None)
+        data["stats"] = PurgeStats(**data.get("stats", {}))
+        job = cls(**data)
+        job.mark()
+        return job
+
+async def stream_purge(channel: discord.abc.Messageable, job: PurgeJob,
+                       checkpoint: Callable[[PurgeJob], Awaitable] | None = None,
+                       index: MessageIndex | None = None) -> PurgeStats:
+    """Один проход по истории от курсора задачи; найденное сразу уходит на удаление пачками.
+
+    С готовым индексом канала цели находятся локально, а история читается только ниже его границы.
+    """
+    predicate = job.predicate()
+    batch: list[discord.abc.Snowflake] = []
+
+    async def flush(cursor: int, indexed: bool = False):
+        nonlocal batch
+        if batch:
+            deleted = job.stats.deleted
+            await delete_messages(channel, batch, job.stats)
+            if indexed:
+                # id из индекса могли устареть за обрыв связи — засчитываем только удалённое
+                job.matched += job.stats.deleted - deleted
+            batch = []
+        # всё новее курсора обработано — с него и продолжим после перезапуска
+        job.before = cursor
+        job.mark()
+        if checkpoint:
+            await checkpoint(job)
+
+    if index is not None and index.ready:
+        while job.matched < job.count:
+            limit = job.count - job.matched
+            found, scanned = index.find(predicate, job.before, job.after, limit)
+            job.scanned += scanned
+            metrics.inc("fler_index_hits_total", len(found))
+            for i in range(0, len(found), BULK_DELETE_CHUNK):
+                batch = [discord.Object(id=msg_id) for msg_id in found[i:i + BULK_DELETE_CHUNK]]
+                await flush(batch[-1].id, indexed=True)
+            if len(found) < limit:
+                break
+        if job.matched >= job.count or index.floor <= (job.after or 0):
+            return job.stats
+        # индекс кончился раньше окна — дальше история строго ниже его границы, без повторов
+        if job.before is None or job.before > index.floor:
+            job.before = index.floor
+
+    async for page in history_pages(channel, _snowflake(job.before), _snowflake(job.after)):
+        for msg in page:
+            job.scanned += 1
+            if not predicate(msg.author.id, normalize_text(msg.content)):
+                continue
+            batch.append(msg)
+            job.matched += 1
+            if len(batch) >= BULK_DELETE_CHUNK or job.matched >= job.count:
+                await flush(msg.id)
+            if job.matched >= job.count:
+                return job.stats
+        if not batch:
+            await flush(page[-1].id)
+    if batch:
+        await flush(batch[-1].id)
+    return job.stats
+
+class JobManager:
+    """Очередь очисток сервера: по одной на канал, места делит с другими серверами через purge_slots, с отменой и чекпоинтами."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: dict[int, PurgeJob] = {}
+        self.finished: deque[PurgeJob] = deque(maxlen=10)
+        self.closing = False
+        self._next_id = 1
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._channel_locks: dict[int, asyncio.Lock] = {}
+        self.running = 0
+        self._save_lock = asyncio.Lock()
+        self._resumed = False
+
+    # ----- хранение -----
+    def _dump(self) -> dict:
+        return {"next_id": self._next_id,
+                "jobs": [job.to_dict() for job in self.jobs.values()]}
+
+    def _write(self, data: dict) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    async def save(self, job: PurgeJob | None = None) -> None:
+        # запись идёт в отдельном потоке — не даём двум записям пересечься
+        async with self._save_lock:
+            await asyncio.to_thread(self._write, self._dump())
+
+    def save_now(self) -> None:
+        self._write(self._dump())
+
+    # ----- запуск -----
+    def submit(self, job: PurgeJob) -> PurgeJob:
+        job.id = self._next_id
+        self._next_id += 1
+        job.mark()
+        self.jobs[job.id] = job
+        self._start(job)
+        return job
+
+    def _start(self, job: PurgeJob) -> None:
+        self._tasks[job.id] = asyncio.create_task(self._run(job))
+
+    def resume(self) -> None:
+        """Подхватывает задачи, прерванные перезапуском (один раз за жизнь процесса)."""
+        if self._resumed:
+            return
+        self._resumed = True
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._next_id = max(self._next_id, data.get("next_id", 1))
+        for raw in data.get("jobs", []):
+            job = PurgeJob.from_dict(raw)
+            job.state = "в очереди"
+            self.jobs[job.id] = job
+            self._start(job)
+
+    def cancel(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def suspend(self) -> None:
+        """Выключение бота: незавершённые задачи остаются на диске и продолжатся после старта."""
+        self.closing = True
+        if self._resumed or self.jobs:  # иначе затрём ещё не прочитанный файл
+            self.save_now()
+
+    # ----- выполнение -----
+    async def _report(self, job: PurgeJob, channel: discord.TextChannel) -> None:
+        """Периодически обновляет сообщение о ходе очистки."""
+        while True:
+            try:
+                if job.status_message_id is None:
+                    msg = await rest.call(PRIO_LOG, "send", channel.id, channel.send, job.progress())
+                    job.status_message_id = msg.id
+                else:
+                    await rest.call(PRIO_LOG, "send", channel.id,
+                                    channel.get_partial_message(job.status_message_id).edit,
+                                    content=job.progress())
+            except discord.NotFound:
+                job.status_message_id = None
+                continue
+            except discord.HTTPException:
+                pass
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+
+    @staticmethod
+    async def _author(job: PurgeJob, guild: discord.Guild) -> discord.abc.Snowflake:
+        """Кто поставил задачу. Без участников в кэше спрашиваем API; не вышло — в журнал уйдёт хотя бы id."""
+        author = guild.get_member(job.author_id) or bot.get_user(job.author_id)
+        if author is not None:
+            return author
+        try:
+            return await rest.call(PRIO_LOG, "user", None, bot.fetch_user, job.author_id)
+        except discord.HTTPException:
+            return discord.Object(id=job.author_id)
+
+    async def _run(self, job: PurgeJob) -> None:
+        current_command.set(job.command or None)
+        channel = bot.get_channel(job.channel_id)
+        if channel is None:
+            job.state = "ошибка"
+            await self._finish(job)
+            return
+        author = await self._author(job, channel.guild)
+        send_dm = not isinstance(author, discord.Object)
+        lock = self._channel_locks.setdefault(job.channel_id, asyncio.Lock())
+        reporter = None
+        try:
+            async with lock:
+                await purge_slots.acquire(self.running)
+                self.running += 1
+                try:
+                    job.state = "выполняется"
+                    reporter = asyncio.create_task(self._report(job, channel))
+                    index = guilds.get(job.guild_id).indexes.get(job.channel_id)
+                    with metrics.timer("fler_purge_job_seconds", kind=job.kind):
+                        await stream_purge(channel, job, self.save, index)
+                finally:
+                    self.running -= 1
+                    purge_slots.release()
+            job.state = "готово"
+            await log_action(channel, author,
+                             f"{job.summary}: {job.stats}.", extra=f" задача #{job.id}",
+                             level=job.stats.level, send_dm=send_dm, stats=job.stats)
+        except asyncio.CancelledError:
+            if self.closing:
+                raise  # бот выключается — задача продолжится после перезапуска
+            job.state = "отменено"
+            await log_action(channel, author,
+                             f"Очистка #{job.id} отменена: {job.summary}: {job.stats}.",
+                             level="warn", send_dm=send_dm, stats=job.stats)
+        except Exception as e:
+            job.state = "ошибка"
+            await log_action(channel, author,
+                             f"Не удалось выполнить очистку #{job.id}: {e}",
+                             level="error", send_dm=send_dm)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+        await self._finish(job, channel)
+
+    async def _finish(self, job: PurgeJob, channel: discord.TextChannel | None = None) -> None:
+        self.jobs.pop(job.id, None)
+        self._tasks.pop(job.id, None)
+        self.finished.append(job)
+        if channel is not None and job.status_message_id is not None:
+            try:
+                await rest.call(PRIO_LOG, "delete", channel.id,
+                                channel.get_partial_message(job.status_message_id).delete)
+            except discord.HTTPException:
+                pass
+        await self.save()
+
+# ---------- состояние серверов ----------
+class GuildState:
+    """Всё, что бот держит для одного сервера: настройки, карту комнат, игроков, очереди логов и очисток."""
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.config = guild_config(guild_id)
+        self.rooms = RoomGraph(guild_path(ROOMS_SNAPSHOT_PATH, guild_id))
+        self.log = LogPipeline(guild_id, self.config.log_channel_id)
+        self.jobs = JobManager(guild_path(PURGE_JOBS_PATH, guild_id))
+        self.locations = LocationStore(guild_path(LOCATIONS_PATH, guild_id))
+        self.indexes = {channel_id: MessageIndex() for channel_id in self.config.indexed_channel_ids}
+
+class GuildRegistry:
+    """Состояние по серверам; создаётся при первом обращении, 0 — общее для событий без сервера."""
+
+    def __init__(self):
+        self.states: dict[int, GuildState] = {}
+        self.running = False
+
+    def start(self) -> None:
+        """Запуск отправки логов — уже созданных серверов и всех следующих."""
+        self.running = True
+        for state in self.states.values():
+            state.log.start()
+
+    def get(self, guild_id: int | None) -> GuildState:
+        guild_id = guild_id or 0
+        state = self.states.get(guild_id)
+        if state is None:
+            state = self.states[guild_id] = GuildState(guild_id)
+            if self.running:
+                state.log.start()
+        return state
+
+    def rooms_for(self, guild_id: int | None, channel_id: int) -> RoomGraph | None:
+        """Карта сервера, если channel_id — его канал-источник комнат."""
+        if guild_id is None or guild_config(guild_id).rooms_source_channel_id != channel_id:
+            return None
+        return self.get(guild_id).rooms
+
+    def __iter__(self):
+        return iter(list(self.states.values()))
+
+guilds = GuildRegistry()
+metrics.gauge("fler_guilds", lambda: len(guilds.states))
+metrics.gauge("fler_log_queue", lambda: sum(s.log.queue.qsize() for s in guilds))
+metrics.gauge("fler_purge_jobs", lambda: sum(len(s.jobs.jobs) for s in guilds))
+metrics.gauge("fler_players", lambda: sum(len(s.locations.where) for s in guilds))
+metrics.gauge("fler_indexed_messages", lambda: sum(len(i) for s in guilds for i in s.indexes.values()))
+
+async def start_purge(ctx: commands.Context, job: PurgeJob) -> PurgeJob:
+    """Ставит очистку канала команды в очередь; история просматривается от сообщения команды."""
+    job.guild_id = ctx.guild.id
+    job.channel_id = ctx.channel.id
+    job.author_id = ctx.author.id
+    job.command = ctx.command.qualified_name
+    if job.before is None:
+        job.before = ctx.message.id
+    jobs = guilds.get(ctx.guild.id).jobs
+    jobs.submit(job)
+    await jobs.save()
+    return job
+
 # ------------------------------------------------------------------
 #  КОМАНДЫ ОЧИСТКИ (со встроенным логированием и раскраской embed’ов)
 # ------------------------------------------------------------------
@@ -99,11 +2052,8 @@ async def очистить(ctx: commands.Context, count: int):
                              level="warn")
             return
 
-        await ctx.message.delete()
-        deleted = await ctx.channel.purge(limit=count)
-        await log_action(ctx.channel, ctx.author,
-                         f"Успешно удалено {len(deleted)} сообщений.",
-                         level="success")
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
+        await start_purge(ctx, PurgeJob("all", count, f"Очистка последних {count}"))
     except commands.BadArgument:
         await log_action(ctx.channel, ctx.author,
                          "Ошибка синтаксиса: `!очистить <целое-число>`.",
@@ -124,26 +2074,9 @@ async def очиститьюзера(ctx: commands.Context, count: int, member:
                              level="warn")
             return
 
-        await ctx.message.delete()
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
 
-        def check(msg):
-            return msg.author == member
-
-        deleted = await ctx.channel.purge(limit=200, check=check, bulk=True)
-        to_delete = deleted[:count]
-
-        # Добираем оставшиеся вручную, если нужно
-        if len(to_delete) < count:
-            async for msg in ctx.channel.history(limit=None):
-                if msg.author == member and msg not in to_delete:
-                    await msg.delete()
-                    to_delete.append(msg)
-                    if len(to_delete) >= count:
-                        break
-
-        await log_action(ctx.channel, ctx.author,
-                         f"Удалено {len(to_delete)} сообщений от {member}.",
-                         level="success")
+        await start_purge(ctx, PurgeJob("user", count, f"Сообщения от {member}", member.id))
     except commands.MissingRequiredArgument:
         await log_action(ctx.channel, ctx.author,
                          "Ошибка синтаксиса: `!очиститьюзера <N> @Пользователь`.",
@@ -156,7 +2089,7 @@ async def очиститьюзера(ctx: commands.Context, count: int, member:
 @bot.command(name="очиститьфразы")
 @commands.has_permissions(manage_messages=True)
 async def очиститьфразы(ctx: commands.Context, count: int, *, phrase: str):
-    """!очиститьфразы <N> "фраза" — удалить N сообщений, содержащих фразу."""
+    """!очиститьфразы <N> "фраза" ["фраза2" "re:шаблон" ...] — удалить N сообщений, содержащих любую из фраз."""
     try:
         if not has_allowed_role(ctx.author):
             await log_action(ctx.channel, ctx.author,
@@ -164,28 +2097,20 @@ async def очиститьфразы(ctx: commands.Context, count: int, *, phras
                              level="warn")
             return
 
-        await ctx.message.delete()
-
-        def check(msg):
-            return phrase.lower() in msg.content.lower()
-
-        deleted = await ctx.channel.purge(limit=200, check=check, bulk=True)
-        to_delete = deleted[:count]
-
-        if len(to_delete) < count:
-            async for msg in ctx.channel.history(limit=None):
-                if phrase.lower() in msg.content.lower() and msg not in to_delete:
-                    await msg.delete()
-                    to_delete.append(msg)
-                    if len(to_delete) >= count:
-                        break
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
 
+        phrases = parse_phrases(phrase)
+        PhraseMatcher(phrases)  # ошибки в регулярках — сразу, а не в фоне
+        await start_purge(ctx, PurgeJob("contains", count,
+                                        f"Сообщения, содержащие {describe_phrases(phrases)}",
+                                        phrases))
+    except re.error as e:
         await log_action(ctx.channel, ctx.author,
-                         f"Удалено {len(to_delete)} сообщений, содержащих «{phrase}».",
-                         level="success")
-    except commands.BadArgument:
+                         f"Ошибка в регулярном выражении: {e}",
+                         level="warn")
+    except commands.BadArgument as e:
         await log_action(ctx.channel, ctx.author,
-                         "Ошибка синтаксиса: `!очиститьфразы <N> \"фраза\"`.",
+                         f"Ошибка синтаксиса: {e}. `!очиститьфразы <N> \"фраза\"`.",
                          level="warn")
     except Exception as e:
         await log_action(ctx.channel, ctx.author,
@@ -195,7 +2120,7 @@ async def очиститьфразы(ctx: commands.Context, count: int, *, phras
 @bot.command(name="точнаяочистка")
 @commands.has_permissions(manage_messages=True)
 async def точнаяочистка(ctx: commands.Context, count: int, *, phrase: str):
-    """!точнаяочистка <N> "фраза" — удалить N сообщений, где текст = фразе."""
+    """!точнаяочистка <N> "фраза" ["фраза2" "re:шаблон" ...] — удалить N сообщений, где текст = одной из фраз."""
     try:
         if not has_allowed_role(ctx.author):
             await log_action(ctx.channel, ctx.author,
@@ -203,28 +2128,20 @@ async def точнаяочистка(ctx: commands.Context, count: int, *, phras
                              level="warn")
             return
 
-        await ctx.message.delete()
-
-        def check(msg):
-            return msg.content.lower() == phrase.lower()
-
-        deleted = await ctx.channel.purge(limit=200, check=check, bulk=True)
-        to_delete = deleted[:count]
-
-        if len(to_delete) < count:
-            async for msg in ctx.channel.history(limit=None):
-                if msg.content.lower() == phrase.lower() and msg not in to_delete:
-                    await msg.delete()
-                    to_delete.append(msg)
-                    if len(to_delete) >= count:
-                        break
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
 
+        phrases = parse_phrases(phrase)
+        PhraseMatcher(phrases)  # ошибки в регулярках — сразу, а не в фоне
+        await start_purge(ctx, PurgeJob("exact", count,
+                                        f"Сообщения, точно совпадающие с {describe_phrases(phrases)}",
+                                        phrases))
+    except re.error as e:
         await log_action(ctx.channel, ctx.author,
-                         f"Удалено {len(to_delete)} сообщений, точно совпадающих с «{phrase}».",
-                         level="success")
-    except commands.BadArgument:
+                         f"Ошибка в регулярном выражении: {e}",
+                         level="warn")
+    except commands.BadArgument as e:
         await log_action(ctx.channel, ctx.author,
-                         "Ошибка синтаксиса: `!точнаяочистка <N> \"фраза\"`.",
+                         f"Ошибка синтаксиса: {e}. `!точнаяочистка <N> \"фраза\"`.",
                          level="warn")
     except Exception as e:
         await log_action(ctx.channel, ctx.author,
@@ -253,85 +2170,373 @@ async def очиститьпосле(ctx: commands.Context, url: str, count: int
         if not has_allowed_role(ctx.author):
             await log_action(ctx.channel, ctx.author, "Недостаточно прав", level="warn")
             return
-        await ctx.message.delete()
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
 
         parsed = parse_msg_link(url)
         if not parsed or parsed[0] != ctx.guild.id or parsed[1] != ctx.channel.id:
             await log_action(ctx.channel, ctx.author, "Ссылка некорректна", level="warn")
             return
 
-        target_msg = await ctx.channel.fetch_message(parsed[2])
-
-        # собираем последние N сообщений, заканчивая target_msg
-        msgs_to_delete = []
-        async for msg in ctx.channel.history(limit=None, oldest_first=False):
-            if msg.id == target_msg.id:
-                msgs_to_delete.append(msg)
-                break
-            msgs_to_delete.append(msg)
-            if len(msgs_to_delete) >= count:
-                break
-
-        # если нашли меньше N – берём ровно то количество
-        msgs_to_delete = msgs_to_delete[:count]
-
-        for msg in msgs_to_delete:
-            await msg.delete()
+        target_msg = await rest.call(PRIO_BULK, "history", ctx.channel.id,
+                                     ctx.channel.fetch_message, parsed[2])
 
-        await log_action(ctx.channel, ctx.author,
-                         f"удалено {len(msgs_to_delete)} (до {target_msg.jump_url})",
-                         level="success")
+        # последние N сообщений, но не дальше target_msg (он включительно)
+        await start_purge(ctx, PurgeJob("all", count, f"Очистка до {target_msg.jump_url}",
+                                        after=target_msg.id - 1))
     except commands.BadArgument:
         await log_action(ctx.channel, ctx.author,
                          "Синтаксис: !очиститьпосле <ссылка> <целое-число>", level="warn")
     except Exception as e:
         await log_action(ctx.channel, ctx.author, f"ошибка: {e}", level="error")
 
-# ---------- !очиститьдо ----------
+# ---------- очистка по датам ----------
+RANGE_PURGE_LIMIT = 100_000  # потолок сообщений для одной очистки по датам
+RANGE_PURGE_DELAY = 15       # секунд между оценкой и запуском — время передумать
+RANGE_CANCEL_EMOJI = "❌"
+MOMENT_REGEX = re.compile(r"(\d{2}\.\d{2}\.\d{4})(?:[ T]+(\d{1,2}:\d{2}))?")
+
+def parse_moments(text: str) -> list[tuple[datetime, bool]]:
+    """Моменты «ДД.ММ.ГГГГ [ЧЧ:ММ]» (UTC) из текста: (момент, указано ли время)."""
+    return [(datetime.strptime(f"{date} {clock or '00:00'}", "%d.%m.%Y %H:%M").replace(tzinfo=timezone.utc),
+             bool(clock))
+            for date, clock in MOMENT_REGEX.findall(text)]
+
+def _upper_bound(moment: datetime, with_time: bool) -> datetime:
+    # дата без времени — весь этот день включительно
+    return moment if with_time else moment + timedelta(days=1)
+
+def period_bounds(first: tuple[datetime, bool], second: tuple[datetime, bool]) -> tuple[datetime, datetime]:
+    """Границы периода: первый момент — начало, второй — конец (дата без времени — до конца дня).
+
+    Если моменты перепутаны местами, они меняются — каждый по-прежнему со своей шириной.
+    """
+    lower, upper = first[0], _upper_bound(*second)
+    if lower >= upper:
+        lower, upper = second[0], _upper_bound(*first)
+    return lower, upper
+
+async def estimate_range(channel: discord.TextChannel, after: int | None, before: int,
+                         index: MessageIndex | None) -> tuple[int, bool]:
+    """(сколько сообщений в окне, точно ли): по индексу или первой странице, иначе по её плотности."""
+    if index is not None and index.ready and index.floor <= (after or 0):
+        return index.count(after, before), True
+    page = await rest.call(PRIO_INTERACTION, "history", channel.id, _fetch_page, channel,
+                           discord.Object(id=before), _snowflake(after))
+    if len(page) < HISTORY_PAGE:
+        return len(page), True
+    # плотность первой страницы переносим на остаток окна, до создания канала, если нижней границы нет
+    newest, oldest = page[0].id >> 22, page[-1].id >> 22
+    lower = max(after or 0, channel.id) >> 22
+    rest_ms = max(0, oldest - lower)
+    return len(page) + int(len(page) * rest_ms / max(1, newest - oldest)), False
+
+async def start_range_purge(ctx: commands.Context, lower: datetime | None, upper: datetime,
+                            summary: str) -> None:
+    """Очистка окна дат: границы переводятся в snowflake, история читается только внутри окна."""
+    after = discord.utils.time_snowflake(lower) - 1 if lower else None
+    before = min(discord.utils.time_snowflake(upper), ctx.message.id)
+    index = guilds.get(ctx.guild.id).indexes.get(ctx.channel.id)
+    estimate, exact = await estimate_range(ctx.channel, after, before, index)
+    if not estimate:
+        await log_action(ctx.channel, ctx.author, f"{summary}: сообщений нет.", level="warn")
+        return
+    border = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    if lower and lower > border:
+        how = "пачками"
+    elif upper <= border:
+        how = "по одному — старше 14 дней"
+    else:
+        how = "свежие пачками, старше 14 дней по одному"
+    # оценку показываем до запуска: автор успевает отменить, пока ничего не удалено
+    found = f"{summary} — {'' if exact else 'примерно '}{estimate} сообщений ({how})"
+    notice = await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                             f"{found}. Начну через {RANGE_PURGE_DELAY} с; передумали — "
+                             f"поставьте {RANGE_CANCEL_EMOJI} на это сообщение.")
+    try:
+        await rest.call(PRIO_INTERACTION, "reaction", ctx.channel.id, notice.add_reaction, RANGE_CANCEL_EMOJI)
+    except discord.HTTPException:
+        pass
+    try:
+        await bot.wait_for("raw_reaction_add", timeout=RANGE_PURGE_DELAY,
+                           check=lambda p: (p.message_id == notice.id and p.user_id == ctx.author.id
+                                            and str(p.emoji) == RANGE_CANCEL_EMOJI))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, notice.edit,
+                        content=f"{found}: отменено.", delete_after=30)
+        await log_action(ctx.channel, ctx.author, f"{summary}: отменено до запуска.", level="warn")
+        return
+    job = await start_purge(ctx, PurgeJob("all", RANGE_PURGE_LIMIT, summary, before=before, after=after))
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, notice.edit,
+                    content=f"Очистка #{job.id}: {found}. Отменить: `{BOT_PREFIX}отменить {job.id}`.",
+                    delete_after=30)
+
 @bot.command(name="очиститьдо")
 @commands.has_permissions(manage_messages=True)
-async def очиститьдо(ctx: commands.Context, url: str, count: int):
-    """!очиститьдо <ссылка> <N> – удалить ровно N сообщений, начиная с указанного (включительно) и ранее."""
+async def очиститьдо(ctx: commands.Context, *, args: str = ""):
+    """!очиститьдо ДД.ММ.ГГГГ [ЧЧ:ММ] – удалить всё до даты (день включительно); или <ссылка> <N>."""
     try:
         if not has_allowed_role(ctx.author):
             await log_action(ctx.channel, ctx.author, "Недостаточно прав", level="warn")
             return
-        await ctx.message.delete()
-
-        parsed = parse_msg_link(url)
-        if not parsed or parsed[0] != ctx.guild.id or parsed[1] != ctx.channel.id:
-            await log_action(ctx.channel, ctx.author, "Ссылка некорректна", level="warn")
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
+
+        tokens = args.split()
+        if tokens and URL_REGEX.match(tokens[0]):
+            # прежний вид: <ссылка> <N> — ровно N сообщений, начиная с указанного и ранее
+            parsed = parse_msg_link(tokens[0])
+            if not parsed or parsed[0] != ctx.guild.id or parsed[1] != ctx.channel.id:
+                await log_action(ctx.channel, ctx.author, "Ссылка некорректна", level="warn")
+                return
+            if len(tokens) != 2 or not tokens[1].isdigit():
+                raise commands.BadArgument
+            target_msg = await rest.call(PRIO_BULK, "history", ctx.channel.id,
+                                         ctx.channel.fetch_message, parsed[2])
+            await start_purge(ctx, PurgeJob("all", int(tokens[1]), f"Очистка от {target_msg.jump_url} и ранее",
+                                            before=target_msg.id + 1))
             return
 
-        target_msg = await ctx.channel.fetch_message(parsed[2])
-        before_dt = target_msg.created_at
+        moments = parse_moments(args)
+        if len(moments) != 1:
+            raise commands.BadArgument
+        moment, with_time = moments[0]
+        upper = _upper_bound(moment, with_time)
+        summary = f"Очистка до {args.strip()}" + ("" if with_time else " включительно")
+        await start_range_purge(ctx, None, upper, summary)
+    except commands.BadArgument:
+        await log_action(ctx.channel, ctx.author,
+                         "Синтаксис: !очиститьдо ДД.ММ.ГГГГ [ЧЧ:ММ] или !очиститьдо <ссылка> <целое-число>",
+                         level="warn")
+    except Exception as e:
+        await log_action(ctx.channel, ctx.author, f"ошибка: {e}", level="error")
 
-        msgs_to_delete = []
-        async for msg in ctx.channel.history(limit=None, before=before_dt, oldest_first=False):
-            if len(msgs_to_delete) >= count - 1:
-                break
-            msgs_to_delete.append(msg)
-        msgs_to_delete.append(target_msg)
+@bot.command(name="очиститьпериод")
+@commands.has_permissions(manage_messages=True)
+async def очиститьпериод(ctx: commands.Context, *, args: str = ""):
+    """!очиститьпериод ДД.ММ.ГГГГ [ЧЧ:ММ] ДД.ММ.ГГГГ [ЧЧ:ММ] – удалить всё между двумя моментами."""
+    try:
+        if not has_allowed_role(ctx.author):
+            await log_action(ctx.channel, ctx.author, "Недостаточно прав", level="warn")
+            return
+        await rest.call(PRIO_BULK, "delete", ctx.channel.id, ctx.message.delete)
+
+        moments = parse_moments(args)
+        if len(moments) != 2:
+            raise commands.BadArgument
+        lower, upper = period_bounds(*moments)
+        if lower >= upper:
+            await log_action(ctx.channel, ctx.author, "Период пуст: начало совпадает с концом.", level="warn")
+            return
+        await start_range_purge(ctx, lower, upper, f"Очистка за период {args.strip()}")
+    except commands.BadArgument:
+        await log_action(ctx.channel, ctx.author,
+                         "Синтаксис: !очиститьпериод ДД.ММ.ГГГГ [ЧЧ:ММ] ДД.ММ.ГГГГ [ЧЧ:ММ]", level="warn")
+    except Exception as e:
+        await log_action(ctx.channel, ctx.author, f"ошибка: {e}", level="error")
 
-        msgs_to_delete = msgs_to_delete[:count]
+# ---------- управление очистками ----------
+@bot.command(name="задачи")
+@commands.has_permissions(manage_messages=True)
+async def задачи(ctx: commands.Context):
+    """!задачи — показать текущие и недавние очистки."""
+    if not has_allowed_role(ctx.author):
+        await log_action(ctx.channel, ctx.author,
+                         "Недостаточно прав для использования команды `задачи`.",
+                         level="warn")
+        return
+    jobs = guilds.get(ctx.guild.id).jobs
+    lines = [job.progress() for job in jobs.jobs.values()]
+    lines += [job.progress() for job in reversed(jobs.finished)]
+    embed = discord.Embed(title="Очистки",
+                          description="\n".join(lines)[:4000] or "Очисток нет.",
+                          color=0x00bfff)
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                    embed=embed, delete_after=60)
+
+@bot.command(name="отменить")
+@commands.has_permissions(manage_messages=True)
+async def отменить(ctx: commands.Context, job_id: int):
+    """!отменить <номер> — остановить очистку."""
+    if not has_allowed_role(ctx.author):
+        await log_action(ctx.channel, ctx.author,
+                         "Недостаточно прав для использования команды `отменить`.",
+                         level="warn")
+        return
+    if not guilds.get(ctx.guild.id).jobs.cancel(job_id):
+        await log_action(ctx.channel, ctx.author,
+                         f"Очистка #{job_id} не найдена или уже завершена.", level="warn")
 
-        for msg in msgs_to_delete:
-            await msg.delete()
+# ---------- метрики ----------
+def _fmt_hist(hist: Histogram) -> str:
+    return (f"{hist.count} шт, p50 {hist.quantile(0.5) * 1000:.0f} мс, "
+            f"p99 {hist.quantile(0.99) * 1000:.0f} мс")
 
+@bot.command(name="метрики")
+@commands.has_permissions(manage_messages=True)
+async def метрики(ctx: commands.Context):
+    """!метрики — сводка по задержкам, удалениям и очередям."""
+    if not has_allowed_role(ctx.author):
         await log_action(ctx.channel, ctx.author,
-                         f"удалено {len(msgs_to_delete)} до {target_msg.jump_url}",
-                         level="success")
-    except commands.BadArgument:
+                         "Недостаточно прав для использования команды `метрики`.",
+                         level="warn")
+        return
+    embed = discord.Embed(title="Метрики", color=0x00bfff)
+    commands_lines = [f"`{dict(key)['command']}` — {_fmt_hist(hist)}"
+                      for key, hist in metrics.histograms.get("fler_command_seconds", {}).items()]
+    embed.add_field(name="Команды", value="\n".join(commands_lines) or "—", inline=False)
+    stage_lines = [f"{dict(key)['stage']} — {_fmt_hist(hist)}"
+                   for key, hist in metrics.histograms.get("fler_stage_seconds", {}).items()
+                   if dict(key)["command"] == "move"]
+    embed.add_field(name="Этапы /move", value="\n".join(stage_lines) or "—", inline=False)
+    autocomplete = metrics.histograms.get("fler_autocomplete_seconds", {}).get(())
+    embed.add_field(name="Автокомплит", value=_fmt_hist(autocomplete) if autocomplete else "—",
+                    inline=False)
+    embed.add_field(
+        name="История и удаления",
+        value=(f"страниц {metrics.total('fler_history_pages_total'):.0f}, "
+               f"просмотрено {metrics.total('fler_messages_scanned_total'):.0f}, "
+               f"удалено {metrics.total('fler_messages_deleted_total'):.0f} "
+               f"({metrics.rate('fler_messages_deleted_total'):.1f}/с за минуту)"),
+        inline=False)
+    embed.add_field(
+        name="REST и очереди",
+        value=(f"429: {metrics.total('fler_rest_429_total'):.0f}, "
+               f"ждут лимита: {rest.waiting}, "
+               f"логов в очереди: {sum(s.log.queue.qsize() for s in guilds)}, "
+               f"очисток: {sum(len(s.jobs.jobs) for s in guilds)}, серверов: {len(bot.guilds)}"),
+        inline=False)
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                    embed=embed, delete_after=120)
+
+# ---------- карта ----------
+@bot.command(name="карта")
+@commands.has_permissions(manage_messages=True)
+async def карта(ctx: commands.Context):
+    """!карта — комнаты без входа и тупики, из которых не вернуться."""
+    if not has_allowed_role(ctx.author):
         await log_action(ctx.channel, ctx.author,
-                         "Синтаксис: !очиститьдо <ссылка> <целое-число>", level="warn")
-    except Exception as e:
-        await log_action(ctx.channel, ctx.author, f"ошибка: {e}", level="error")
+                         "Недостаточно прав для использования команды `карта`.",
+                         level="warn")
+        return
+    graph = guilds.get(ctx.guild.id).rooms
+    unreachable, traps = graph.router.report()
+    embed = discord.Embed(title="Карта",
+                          description=f"Комнат в списке: {len(graph.rooms)}",
+                          color=0x00bfff)
+    embed.add_field(name=f"Без входа ({len(unreachable)})",
+                    value=", ".join(unreachable)[:1024] or "—", inline=False)
+    embed.add_field(name=f"Тупики ({len(traps)})",
+                    value=", ".join(traps)[:1024] or "—", inline=False)
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                    embed=embed, delete_after=120)
+
+@bot.command(name="где")
+@commands.has_permissions(manage_messages=True)
+async def где(ctx: commands.Context, member: discord.Member | None = None):
+    """!где [@участник] — в какой комнате игрок; без упоминания — все игроки по комнатам."""
+    if not has_allowed_role(ctx.author):
+        await log_action(ctx.channel, ctx.author,
+                         "Недостаточно прав для использования команды `где`.",
+                         level="warn")
+        return
+    locations = guilds.get(ctx.guild.id).locations
+    if member is not None:
+        channel_id = locations.where.get(member.id)
+        text = f"{member.mention} — <#{channel_id}>" if channel_id else f"{member.mention} ни в одной комнате."
+        await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send, text,
+                        allowed_mentions=discord.AllowedMentions.none(), delete_after=60)
+        return
+    lines = [f"<#{channel_id}>: " + ", ".join(f"<@{m}>" for m in members)
+             for channel_id, members in sorted(locations.by_channel().items(),
+                                               key=lambda item: -len(item[1]))]
+    description = ""
+    for i, line in enumerate(lines):
+        if len(description) + len(line) > 3900:
+            description += f"…и ещё {len(lines) - i} комнат"
+            break
+        description += line + "\n"
+    embed = discord.Embed(title=f"Игроки ({len(locations.where)})",
+                          description=description or "Никого нет.", color=0x00bfff)
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                    embed=embed, delete_after=120)
+
+# ---------- журнал ----------
+AUDIT_MENTION = re.compile(r"^<(@!?|#)(\d+)>$")
+AUDIT_PERIOD = re.compile(r"^(\d+)([мчдн])$")
+AUDIT_PERIOD_UNITS = {"м": 60, "ч": 3600, "д": 86400, "н": 7 * 86400}
+
+def parse_audit_filters(args: Iterable[str]) -> dict:
+    """@участник, #канал, команда, период (7д, 12ч, 30м, 2н) или даты ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]."""
+    filters: dict = {}
+    dates: list[datetime] = []
+    for arg in args:
+        if match := AUDIT_MENTION.match(arg):
+            filters["channel_id" if match.group(1) == "#" else "actor_id"] = int(match.group(2))
+        elif match := AUDIT_PERIOD.match(arg):
+            filters["since"] = time.time() - int(match.group(1)) * AUDIT_PERIOD_UNITS[match.group(2)]
+        elif re.fullmatch(r"\d{2}\.\d{2}\.\d{4}", arg):
+            dates.append(datetime.strptime(arg, "%d.%m.%Y").replace(tzinfo=timezone.utc))
+        else:
+            command = bot.get_command(arg) or bot.tree.get_command(arg)
+            if command is None:
+                raise commands.BadArgument(f"Не понимаю фильтр `{arg}`")
+            filters["command"] = command.qualified_name
+    if dates:
+        filters["since"] = min(dates).timestamp()
+        filters["until"] = (max(dates) + timedelta(days=1)).timestamp()
+    return filters
+
+def _fmt_audit(row) -> str:
+    line = f"<t:{int(row['ts'])}:f> "
+    line += f"<@{row['actor_id']}>" if row["actor_id"] else "—"
+    if row["command"]:
+        line += f" `{row['command']}`"
+    if row["channel_id"]:
+        line += f" <#{row['channel_id']}>"
+    if row["target_id"]:
+        line += f" → <#{row['target_id']}>"
+    if row["deleted"] is not None:
+        line += f" удалено {row['deleted']}"
+        if row["failed"]:
+            line += f", ошибок {row['failed']}"
+    return line + f" — {row['text'][:100]}"
+
+@bot.command(name="аудит")
+@commands.has_permissions(manage_messages=True)
+async def аудит(ctx: commands.Context, *args: str):
+    """!аудит [@участник] [#канал] [команда] [7д | ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]] — поиск по журналу действий."""
+    if not has_allowed_role(ctx.author):
+        await log_action(ctx.channel, ctx.author,
+                         "Недостаточно прав для использования команды `аудит`.",
+                         level="warn")
+        return
+    try:
+        filters = parse_audit_filters(args)
+    except commands.BadArgument as e:
+        await log_action(ctx.channel, ctx.author, str(e), level="warn")
+        return
+    started = time.perf_counter()
+    rows = await audit.query(ctx.guild.id, **filters)
+    elapsed = (time.perf_counter() - started) * 1000
+    metrics.observe("fler_audit_query_seconds", elapsed / 1000)
+    description = ""
+    for row in rows:
+        line = _fmt_audit(row)
+        if len(description) + len(line) > 3900:
+            break
+        description += line + "\n"
+    embed = discord.Embed(title="Журнал", description=description or "Ничего не найдено.",
+                          color=0x00bfff)
+    embed.set_footer(text=f"{len(rows)} записей, {elapsed:.1f} мс")
+    await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                    embed=embed, allowed_mentions=discord.AllowedMentions.none(), delete_after=300)
 
 # --------------------- HELP ---------------------
 @bot.command(aliases=["помоги", "help"])
 async def help_cmd(ctx: commands.Context):
     """!help — отправляет список команд в личные сообщения."""
-    await ctx.message.delete()
+    await rest.call(PRIO_INTERACTION, "delete", ctx.channel.id, ctx.message.delete)
     embed = discord.Embed(
         title="Команды очистки чата",
         description="Все команды требуют одну из разрешённых ролей.",
@@ -348,127 +2553,470 @@ async def help_cmd(ctx: commands.Context):
         inline=False
     )
     embed.add_field(
-        name=f"{BOT_PREFIX}очиститьфразы <N> \"фраза\"",
-        value="Удалить N сообщений, содержащих указанную фразу (регистр не учитывается).",
+        name=f"{BOT_PREFIX}очиститьфразы <N> \"фраза\" [\"фраза2\" ...]",
+        value="Удалить N сообщений, содержащих любую из фраз (регистр не учитывается). "
+              "Фраза вида \"re:шаблон\" — регулярное выражение.",
         inline=False
     )
     embed.add_field(
-        name=f"{BOT_PREFIX}точнаяочистка <N> \"фраза\"",
-        value="Удалить N сообщений, текст которых **точно совпадает** с указанной фразой.",
+        name=f"{BOT_PREFIX}точнаяочистка <N> \"фраза\" [\"фраза2\" ...]",
+        value="Удалить N сообщений, текст которых **точно совпадает** с одной из фраз.",
         inline=False
     )
     embed.add_field(
-        name=f"{BOT_PREFIX}очиститьдо ДД.ММ.ГГГГ",
-        value="Удалить все сообщения до указанной даты (включительно).",
+        name=f"{BOT_PREFIX}очиститьдо ДД.ММ.ГГГГ [ЧЧ:ММ]",
+        value="Удалить все сообщения до указанной даты (день включительно) или до момента. Время — UTC.",
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}очиститьпериод ДД.ММ.ГГГГ [ЧЧ:ММ] ДД.ММ.ГГГГ [ЧЧ:ММ]",
+        value=("Удалить все сообщения между двумя датами. Перед запуском показывает, сколько их примерно, "
+               f"и ждёт {RANGE_PURGE_DELAY} с — {RANGE_CANCEL_EMOJI} под оценкой отменяет."),
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}задачи / {BOT_PREFIX}отменить <номер>",
+        value="Очистки идут в фоне: посмотреть их ход или остановить.",
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}метрики",
+        value="Сводка по задержкам команд, удалениям и очередям.",
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}карта",
+        value="Комнаты, в которые не ведёт ни один выход, и тупики, из которых не вернуться.",
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}аудит [@Пользователь] [#канал] [команда] [7д | ДД.ММ.ГГГГ]",
+        value="Последние действия из журнала: кто, что и где делал. "
+              "Период — 30м, 12ч, 7д, 2н или одна-две даты.",
+        inline=False
+    )
+    embed.add_field(
+        name=f"{BOT_PREFIX}где [@Пользователь]",
+        value="В какой комнате игрок; без упоминания — все игроки по комнатам.",
         inline=False
     )
     try:
-        await ctx.author.send(embed=embed)
+        await rest.call(PRIO_INTERACTION, "dm", None, ctx.author.send, embed=embed)
     except discord.Forbidden:
-        await ctx.send("Не получается отправить вам личное сообщение. Возможно, у вас закрыты ЛС.", delete_after=10)
+        await rest.call(PRIO_INTERACTION, "send", ctx.channel.id, ctx.send,
+                        "Не получается отправить вам личное сообщение. Возможно, у вас закрыты ЛС.", delete_after=10)
 
 # ---------- slash-команда ----------
+class StageTimer:
+    """Замер длительности этапов команды, в миллисекундах."""
+
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.stages: dict[str, float] = {}
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = (now - self._last) * 1000
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        return (self._last - self.started) * 1000
+
+    def report(self, command: str) -> None:
+        for name, ms in self.stages.items():
+            metrics.observe("fler_stage_seconds", ms / 1000, command=command, stage=name)
+        metrics.observe("fler_command_seconds", self.total / 1000, command=command)
+
+    def __str__(self) -> str:
+        parts = " ".join(f"{name} {ms:.0f}" for name, ms in self.stages.items())
+        return f"{parts} | всего {self.total:.0f} мс"
+
+async def restore_overwrite(channel: discord.TextChannel, member: discord.Member,
+                            previous: discord.PermissionOverwrite):
+    """Возвращает участнику прежние права в канале (откат /move)."""
+    await rest.call(PRIO_PERMISSIONS, "permissions", channel.id,
+                    channel.set_permissions, member,
+                    overwrite=None if previous.is_empty() else previous)
+
+@bot.tree.command(name="path", description="Как дойти до комнаты")
+@app_commands.describe(to="Куда нужно попасть", start="Откуда идти (по умолчанию — текущая комната)")
+@app_commands.rename(to="куда", start="откуда")
+@app_commands.autocomplete(to=any_room_autocomplete, start=any_room_autocomplete)
+async def path(interaction: discord.Interaction, to: str, start: str | None = None):
+    current_command.set("path")
+    if start is None:
+        start = getattr(interaction.channel, "name", "")
+    graph = guilds.get(interaction.guild_id).rooms
+    with metrics.timer("fler_stage_seconds", command="path", stage="маршрут"):
+        hops = graph.router.path(start, to)
+    if hops is None:
+        metrics.inc("fler_commands_total", command="path", result="rejected")
+        unreachable, traps = graph.router.report()
+        hint = ""
+        if graph.names.get(to.lower(), to) in unreachable:
+            hint = " В эту комнату не ведёт ни один выход."
+        elif graph.names.get(start.lower(), start) in traps:
+            hint = " Из этой части карты не вернуться."
+        text = f"Из **{start}** не добраться до **{to}**.{hint}"
+    elif not hops:
+        metrics.inc("fler_commands_total", command="path", result="ok")
+        text = f"Вы уже в **{to}**."
+    else:
+        metrics.inc("fler_commands_total", command="path", result="ok")
+        text = f"**{start}** → " + " → ".join(f"**{h}**" for h in hops) + f" ({len(hops)} шаг.)"
+    await rest.call(PRIO_INTERACTION, "interaction", None,
+                    interaction.response.send_message, text[:2000], ephemeral=True)
+
 @bot.tree.command(name="move", description="Переместиться в другую комнату")
-@app_commands.describe(exit="Куда вы хотите пойти")
+@app_commands.describe(exit="Куда вы хотите пойти",
+                       route="Идти через несколько комнат по кратчайшему пути")
+@app_commands.rename(route=MOVE_ROUTE_PARAM)
 @app_commands.autocomplete(exit=room_autocomplete)
-async def move(interaction: discord.Interaction, exit: str):
+async def move(interaction: discord.Interaction, exit: str, route: bool = False):
+    current_command.set("move")
+    timer = StageTimer()
     member = interaction.user
-    guild = interaction.guild
     source_channel = interaction.channel
+    state = guilds.get(interaction.guild_id)
+    category_id = state.config.allowed_category_id
 
     # 1. проверка категории начального канала
     if not isinstance(source_channel, discord.TextChannel) or \
-       source_channel.category_id != ALLOWED_CATEGORY_ID:
+       source_channel.category_id != category_id:
+        metrics.inc("fler_commands_total", command="move", result="rejected")
         await log_action(None, member,
                          f"{member.display_name} /move вне категории",
                          extra="", level="warn", send_dm=False)
-        return await interaction.response.send_message(
+        return await rest.call(
+            PRIO_INTERACTION, "interaction", None, interaction.response.send_message,
             "Команду можно использовать только в разрешённой категории.", ephemeral=True
         )
 
     current_room = source_channel.name
 
-    # 2. парсим список выходов из текущей комнаты
-    list_ch = bot.get_channel(ROOMS_SOURCE_CHANNEL_ID)
-    allowed_exits = []
-    async for msg in list_ch.history(limit=None):
-        parsed = parse_location_line(msg.content)
-        if parsed and parsed[0].lower() == current_room.lower():
-            allowed_exits = parsed[1]
-            break
+    # 2. список выходов из текущей комнаты (из кэша карты)
+    allowed_exits = state.rooms.exits(current_room)
 
-    # 3. проверка, что целевая комната есть в списке выходов
+    # 3. проверка, что целевая комната есть в списке выходов (или до неё есть маршрут)
+    hops = [exit]
     if exit not in allowed_exits:
-        await log_action(source_channel, member,
-                         f"{member.display_name} выхода нет: {exit}",
-                         extra="", level="warn", send_dm=False)
-        return await interaction.response.send_message(
-            f"Из **{current_room}** нет выхода в **{exit}**.", ephemeral=True
-        )
+        hops = state.rooms.router.path(current_room, exit) if route else None
+        if not hops:
+            metrics.inc("fler_commands_total", command="move", result="rejected")
+            await log_action(source_channel, member,
+                             f"{member.display_name} выхода нет: {exit}",
+                             extra="", level="warn", send_dm=False)
+            return await rest.call(
+                PRIO_INTERACTION, "interaction", None, interaction.response.send_message,
+                f"Из **{current_room}** нет {'пути' if route else 'выхода'} в **{exit}**.",
+                ephemeral=True
+            )
+        exit = hops[-1]
+    via = f" через {' → '.join(hops[:-1])}" if len(hops) > 1 else ""
 
     # 4. проверка существования целевого канала
-    target_channel = discord.utils.get(guild.text_channels,
-                                       name=exit,
-                                       category_id=ALLOWED_CATEGORY_ID)
+    target_channel = channel_index.get(category_id, exit)
     if not target_channel:
+        metrics.inc("fler_commands_total", command="move", result="rejected")
         await log_action(source_channel, member,
                          f"{member.display_name} канал не найден: {exit}",
                          extra="", level="warn", send_dm=False)
-        return await interaction.response.send_message(
+        return await rest.call(
+            PRIO_INTERACTION, "interaction", None, interaction.response.send_message,
             f"Канал **{exit}** не существует или вне категории.", ephemeral=True
         )
-
-    # 5. перемещение
-    try:
-        # открываем целевой
-        await target_channel.set_permissions(member, read_messages=True, send_messages=True)
-
-        # сообщение в целевой канал
-        await target_channel.send(f"*Пришёл {member.mention}*")
-
-        # сообщение в текущий канал
-        await interaction.response.send_message(
-            f"{member.display_name} ушёл в {target_channel.mention}"
-        )
-        move_msg = await interaction.original_response()
-
-        # закрываем исходный
-        await source_channel.set_permissions(member, read_messages=False, send_messages=False)
-
-        # логируем
-        await log_action(
-            None,
-            member,
-            f"{member.display_name}",
-            extra=f"{source_channel.mention} → {target_channel.mention} | [**ССЫЛКА**]({move_msg.jump_url})",
-            level="success",
-            send_dm=False
+    # выход-петля ведёт в ту же комнату: открытие и снятие прав в одном канале гонялись бы друг с другом
+    if target_channel.id == source_channel.id:
+        metrics.inc("fler_commands_total", command="move", result="rejected")
+        return await rest.call(
+            PRIO_INTERACTION, "interaction", None, interaction.response.send_message,
+            f"Вы уже в **{current_room}**.", ephemeral=True
         )
-    except discord.Forbidden:
+    timer.mark("проверки")
+
+    # 5. сразу подтверждаем взаимодействие — дальше идут медленные запросы
+    await rest.call(PRIO_INTERACTION, "interaction", None,
+                    interaction.response.defer, thinking=True)
+    timer.mark("defer")
+
+    # 6. права в обоих каналах и сообщение о приходе — параллельно;
+    # в старой комнате право снимается совсем: у игрока остаётся одно — там, где он сейчас
+    prev_source = source_channel.overwrites_for(member)
+    prev_target = target_channel.overwrites_for(member)
+    opened, closed, arrival = await asyncio.gather(
+        rest.call(PRIO_PERMISSIONS, "permissions", target_channel.id,
+                  target_channel.set_permissions, member,
+                  read_messages=True, send_messages=True),
+        rest.call(PRIO_PERMISSIONS, "permissions", source_channel.id,
+                  source_channel.set_permissions, member, overwrite=None),
+        rest.call(PRIO_PERMISSIONS, "send", target_channel.id,
+                  target_channel.send, f"*Пришёл {member.mention}*"),
+        return_exceptions=True,
+    )
+    timer.mark("права")
+
+    if isinstance(opened, Exception) or isinstance(closed, Exception):
+        # откатываем ту сторону, которая успела примениться
+        rollback = []
+        if not isinstance(opened, Exception):
+            rollback.append(restore_overwrite(target_channel, member, prev_target))
+        if not isinstance(closed, Exception):
+            rollback.append(restore_overwrite(source_channel, member, prev_source))
+        if not isinstance(arrival, Exception):
+            rollback.append(rest.call(PRIO_PERMISSIONS, "delete", target_channel.id, arrival.delete))
+        await asyncio.gather(*rollback, return_exceptions=True)
+        timer.mark("откат")
+
+        error = opened if isinstance(opened, Exception) else closed
+        timer.report("move")
+        metrics.inc("fler_commands_total", command="move", result="error")
         await log_action(source_channel, member,
-                         f"{member.display_name} недостаточно прав",
-                         extra="", level="error", send_dm=False)
-        await interaction.response.send_message(
-            "Не удалось изменить права.", ephemeral=True
-        )
+                         f"{member.display_name} не удалось переместиться: {error}",
+                         extra=f" {timer}", level="error", send_dm=False,
+                         source=source_channel, target=target_channel)
+        await rest.call(PRIO_INTERACTION, "interaction", None,
+                        interaction.delete_original_response)
+        await rest.call(PRIO_INTERACTION, "interaction", None, interaction.followup.send,
+                        "Не удалось изменить права.", ephemeral=True)
+        return
+
+    previous_room = state.locations.set(member.id, target_channel.id)
+
+    # 7. ответ в текущий канал
+    move_msg = await rest.call(PRIO_INTERACTION, "interaction", None, interaction.followup.send,
+                               f"{member.display_name} ушёл в {target_channel.mention}{via}",
+                               wait=True)
+    timer.mark("ответ")
+    timer.report("move")
+    metrics.inc("fler_commands_total", command="move", result="ok")
+
+    # логируем
+    await log_action(
+        None,
+        member,
+        f"{member.display_name}",
+        extra=f"{source_channel.mention} → {target_channel.mention}{via} | [**ССЫЛКА**]({move_msg.jump_url}) | {timer}",
+        level="success",
+        send_dm=False,
+        source=source_channel,
+        target=target_channel
+    )
+
+    # хранилище помнило игрока в третьей комнате (например, после ручной правки прав) — снимаем и там
+    stray = bot.get_channel(previous_room) \
+        if previous_room not in (None, source_channel.id, target_channel.id) else None
+    if stray is not None:
+        try:
+            await state.locations.evict(stray, member.id)
+        except discord.HTTPException:
+            pass
 
 # --------------------- ЗАПУСК ---------------------
+@bot.event
+async def setup_hook():
+    guilds.start()
+    await audit.start()
+    await start_metrics_server()
+
+_command_started: dict[int, float] = {}
+
+@bot.before_invoke
+async def _command_timer_start(ctx: commands.Context):
+    _command_started[id(ctx)] = time.perf_counter()
+    current_command.set(ctx.command.qualified_name)
+
+@bot.after_invoke
+async def _command_timer_stop(ctx: commands.Context):
+    started = _command_started.pop(id(ctx), None)
+    if started is not None:
+        metrics.observe("fler_command_seconds", time.perf_counter() - started,
+                        command=ctx.command.qualified_name)
+    result = "error" if ctx.command_failed else "ok"
+    metrics.inc("fler_commands_total", command=ctx.command.qualified_name, result=result)
+
 @bot.event
 async def on_connect():
     now = datetime.now(timezone.utc)
     await log_action(None, bot.user, f"Флер подключилась к Discord ({now:%d.%m.%Y %H:%M:%S} UTC)", level="success")
 
+async def prepare_guild(guild: discord.Guild) -> None:
+    """Индекс каналов, карта комнат и прерванные очистки одного сервера."""
+    state = guilds.get(guild.id)
+    channel_index.load(guild)
+    # карта загружается один раз, дальше её поддерживают события канала-источника;
+    # после новой сессии gateway догоняем то, что пришло бы событиями за время обрыва
+    list_ch = guild.get_channel(state.config.rooms_source_channel_id)
+    if isinstance(list_ch, discord.TextChannel):
+        if state.rooms.loaded:
+            await state.rooms.resync(list_ch)
+        else:
+            await state.rooms.start(list_ch)
+    state.jobs.resume()
+    # где игроки: снимок с диска, затем фоновая сверка прав — сейчас и по расписанию
+    if not state.locations.loaded:
+        await asyncio.to_thread(state.locations.restore)
+    state.locations.start(guild, state.config.allowed_category_id)
+    # локальные индексы дочитывают историю (после новой сессии — пропущенное) в фоне, пока очистки идут по-старому
+    for channel_id, index in state.indexes.items():
+        channel = guild.get_channel(channel_id)
+        if isinstance(channel, discord.TextChannel):
+            index.start(channel)
+    # сразу сообщаем о выходах в несуществующие каналы
+    broken = missing_exits(state.rooms, state.config.allowed_category_id)
+    if broken:
+        listed = ", ".join(f"{room} → {e}" for room, e in broken[:20])
+        more = f" и ещё {len(broken) - 20}" if len(broken) > 20 else ""
+        await log_action(None, bot.user,
+                         f"В карте {len(broken)} выходов без канала",
+                         extra=f" {listed}{more}", level="warn", guild=guild)
+
+def command_tree_hash(guild: discord.abc.Snowflake | None = None) -> str:
+    """Стабильный хэш slash-команд в том виде, в каком их получит Discord."""
+    payload = []
+    for command in bot.tree.get_commands(guild=guild):
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:  # discord.py до 2.4
+            payload.append(command.to_dict())
+    payload.sort(key=lambda c: (c["name"], c.get("type", 1)))
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _write_tree_hashes(hashes: dict[str, str]) -> None:
+    tmp = f"{COMMAND_TREE_HASH_PATH}.{os.getpid()}.tmp"  # свой файл на процесс
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(hashes, f, indent=1)
+    os.replace(tmp, COMMAND_TREE_HASH_PATH)
+
+async def sync_command_tree() -> list[str]:
+    """Публикует slash-команды, только если они изменились с прошлой публикации; возвращает, куда."""
+    # команды общие для всех шардов — публикует только процесс с шардом 0
+    if SHARD_IDS is not None and 0 not in SHARD_IDS:
+        return []
+    try:
+        with open(COMMAND_TREE_HASH_PATH, encoding="utf-8") as f:
+            hashes: dict[str, str] = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    targets: list[discord.Object | None] = [discord.Object(id=g) for g in SYNC_GUILD_IDS] or [None]
+    synced = []
+    for guild in targets:
+        if guild is not None:
+            bot.tree.copy_global_to(guild=guild)
+        scope = str(guild.id) if guild is not None else "global"
+        digest = command_tree_hash(guild)
+        if hashes.get(scope) == digest:
+            continue
+        await rest.call(PRIO_PERMISSIONS, "other", None, bot.tree.sync, guild=guild)
+        hashes[scope] = digest
+        synced.append(scope)
+    if synced:
+        try:
+            await asyncio.to_thread(_write_tree_hashes, hashes)
+        except OSError as e:
+            # команды уже опубликованы; без файла в следующий раз просто опубликуем ещё раз
+            logging.getLogger("fler.sync").warning("Не удалось сохранить хэш команд: %s", e)
+    metrics.inc("fler_tree_syncs_total", len(synced))
+    return synced
+
 @bot.event
 async def on_ready():
-    await bot.tree.sync()
+    # серверы готовятся параллельно: медленная история одного не держит остальные
+    results = await asyncio.gather(*(prepare_guild(g) for g in bot.guilds), return_exceptions=True)
+    for guild, result in zip(bot.guilds, results):
+        if isinstance(result, Exception):
+            await log_action(None, bot.user, f"Не удалось подготовить сервер {guild.name}: {result}",
+                             level="error", guild=guild)
+    # после переподключения команды обычно те же — повторная публикация не нужна
+    try:
+        synced = await sync_command_tree()
+    except discord.HTTPException as e:
+        synced = []
+        await log_action(None, bot.user, f"Не удалось опубликовать slash-команды: {e}", level="error")
+    if synced:
+        await log_action(None, bot.user, "Slash-команды обновлены", extra=f" {', '.join(synced)}")
     now = datetime.now(timezone.utc)
     await log_action(None, bot.user, f"Флер полностью готова к работе ({now:%d.%m.%Y %H:%M:%S} UTC)", level="success")
 
+@bot.listen("on_guild_join")
+async def guilds_on_join(guild: discord.Guild):
+    await prepare_guild(guild)
+
 @bot.event
 async def on_disconnect():
     now = datetime.now(timezone.utc)
     await log_action(None, bot.user, f"Бот отключился от Discord ({now:%d.%m.%Y %H:%M:%S} UTC)", level="warn")
 
+# ---------- синхронизация карты комнат ----------
+@bot.listen("on_message")
+async def rooms_on_message(message: discord.Message):
+    graph = guilds.rooms_for(message.guild and message.guild.id, message.channel.id)
+    if graph is not None:
+        graph.set_message(message.id, message.content)
+
+@bot.listen("on_raw_message_edit")
+async def rooms_on_edit(payload: discord.RawMessageUpdateEvent):
+    # raw-событие: сообщения из истории не лежат в кэше discord.py
+    graph = guilds.rooms_for(payload.guild_id, payload.channel_id)
+    if graph is not None and "content" in payload.data:
+        graph.set_message(payload.message_id, payload.data["content"])
+
+@bot.listen("on_raw_message_delete")
+async def rooms_on_delete(payload: discord.RawMessageDeleteEvent):
+    graph = guilds.rooms_for(payload.guild_id, payload.channel_id)
+    if graph is not None:
+        graph.remove_message(payload.message_id)
+
+@bot.listen("on_raw_bulk_message_delete")
+async def rooms_on_bulk_delete(payload: discord.RawBulkMessageDeleteEvent):
+    graph = guilds.rooms_for(payload.guild_id, payload.channel_id)
+    if graph is not None:
+        for msg_id in payload.message_ids:
+            graph.remove_message(msg_id)
+
+# ---------- синхронизация индекса сообщений ----------
+def _message_index(guild_id: int | None, channel_id: int) -> MessageIndex | None:
+    return guilds.get(guild_id).indexes.get(channel_id) if guild_id else None
+
+@bot.listen("on_message")
+async def index_on_message(message: discord.Message):
+    index = _message_index(message.guild and message.guild.id, message.channel.id)
+    if index is not None:
+        index.add(message.id, message.author.id, message.content)
+
+@bot.listen("on_raw_message_edit")
+async def index_on_edit(payload: discord.RawMessageUpdateEvent):
+    index = _message_index(payload.guild_id, payload.channel_id)
+    if index is not None and "content" in payload.data:
+        index.edit(payload.message_id, payload.data["content"])
+
+@bot.listen("on_raw_message_delete")
+async def index_on_delete(payload: discord.RawMessageDeleteEvent):
+    index = _message_index(payload.guild_id, payload.channel_id)
+    if index is not None:
+        index.remove(payload.message_id)
+
+@bot.listen("on_raw_bulk_message_delete")
+async def index_on_bulk_delete(payload: discord.RawBulkMessageDeleteEvent):
+    index = _message_index(payload.guild_id, payload.channel_id)
+    if index is not None:
+        for msg_id in payload.message_ids:
+            index.remove(msg_id)
+
+# ---------- синхронизация индекса каналов ----------
+@bot.listen("on_guild_channel_create")
+async def channels_on_create(channel: discord.abc.GuildChannel):
+    channel_index.add(channel)
+
+@bot.listen("on_guild_channel_update")
+async def channels_on_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    channel_index.add(after)
+
+@bot.listen("on_guild_channel_delete")
+async def channels_on_delete(channel: discord.abc.GuildChannel):
+    channel_index.remove(channel.id)
+
 @bot.event
 async def on_command_error(ctx: commands.Context, error):
     # 1) Игнорируем ошибки, которые уже обработаны внутри команд
@@ -486,7 +3034,7 @@ async def on_command_error(ctx: commands.Context, error):
             hint = "Такой команды не существует. Используйте `!помощь` для списка."
 
         try:
-            await ctx.author.send(hint)
+            await rest.call(PRIO_INTERACTION, "dm", None, ctx.author.send, hint)
         except discord.Forbidden:
             pass
         return
@@ -496,7 +3044,6 @@ async def on_command_error(ctx: commands.Context, error):
                      f"Ошибка бота: {error}",
                      level="error")
 
-import asyncio
 import signal
 import sys
 
@@ -507,8 +3054,13 @@ async def shutdown():
         await log_action(None, bot.user,
                          f"Флер завершила свою работу ({datetime.now(timezone.utc):%d.%m.%Y %H:%M:%S} UTC)",
                          level="error")
-        # Даём шанс отправить embed
-        await asyncio.sleep(1)
+        for state in guilds:
+            state.rooms.save_now()
+            state.locations.save_now()
+            state.jobs.suspend()
+        # досылаем накопившиеся логи, но не бесконечно
+        await asyncio.gather(*(state.log.flush(LOG_FLUSH_TIMEOUT) for state in guilds))
+        await audit.close()
     except Exception:
         pass
     finally:
@@ -517,8 +3069,9 @@ async def shutdown():
 def handle_signal(signum, frame):
     asyncio.create_task(shutdown())
 
-# регистрируем обработчики Ctrl+C / SIGTERM
-signal.signal(signal.SIGINT,  handle_signal)
-signal.signal(signal.SIGTERM, handle_signal)
+if __name__ == "__main__":
+    # регистрируем обработчики Ctrl+C / SIGTERM
+    signal.signal(signal.SIGINT,  handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
 
-bot.run('')
\ No newline at end of file
+    bot.run('')